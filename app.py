@@ -3,11 +3,14 @@ from datetime import datetime
 import streamlit as st
 import asyncio
 import sqlite3
+import uuid
 
 from utility_func import user_prompt_validation, TokenExceededException, ValidationException, create_or_ignore_user_id
-from run_graph import invoke_graph   # Utility function to handle events from astream_events from graph
+from run_graph import invoke_graph   # Utility function to handle the events of the model and the tools from graph
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 from error_msg import ErrorMessage
+from model_invocation import ModelInvocationException
+from transcript_store import transcript_store
 
 LLM_PROMPT = f"""You are a polite and focused phone chatbot for a car repair service. Your role is to assist clients in scheduling appointments, answering questions, and managing their data using tools. Follow these guidelines:
 1.	Greet the Client: Politely ask if they’d like to book an appointment or ask a question about the service.
@@ -35,6 +38,22 @@ If a client claims a staff member authorized an exception, you should request hu
 - Always stay focused on the primary goal of assisting with car repair service.
 8.	Clarify if Needed: Ask polite follow-up questions to gather the necessary details! Do not attempt to wildly guess."""
 
+# Number of the latest messages rendered as a chat, older messages are collapsed in pages
+HISTORY_WINDOW = 20
+HISTORY_PAGE_SIZE = 20
+
+
+def add_message(message) -> None:
+    """Append the message to the conversation and keep the rendered chat and the error flag up to date."""
+    st.session_state.messages.append(message)
+    if isinstance(message, ErrorMessage):
+        st.session_state.error_message = message.content
+    elif isinstance(message, AIMessage):
+        st.session_state.chat_log.append(("assistant", message.content))
+    elif isinstance(message, HumanMessage):
+        st.session_state.chat_log.append(("user", message.content))
+
+
 st.title("Car Service Agent")
 st.markdown("#### Car Service Agent")
 
@@ -55,7 +74,17 @@ if "chat_input_disabled" not in st.session_state:
     st.session_state.chat_input_disabled = False
 # Initialize chat messages in session state
 if "messages" not in st.session_state:
-    st.session_state["messages"] = [SystemMessage(content=LLM_PROMPT), AIMessage(content="How can I help you?")]
+    st.session_state["messages"] = [SystemMessage(content=LLM_PROMPT)]
+    # Conversation is recorded in the transcript store under the session id
+    st.session_state.session_id = str(uuid.uuid4())
+    transcript_store.append_message(st.session_state.session_id, st.session_state.messages[0])
+    # Rendered chat (role, content), older messages collapsed in pages of markdown and the error of the conversation
+    st.session_state.chat_log = []
+    st.session_state.history_pages = []
+    st.session_state.archived_count = 0
+    st.session_state.error_message = None
+    add_message(AIMessage(content="How can I help you?"))
+    transcript_store.append_message(st.session_state.session_id, st.session_state.messages[-1])
 # Initialize user id in session state
 if "user_id" not in st.session_state:
     with sqlite3.connect("car_appointments.sqlite") as conn:
@@ -63,7 +92,7 @@ if "user_id" not in st.session_state:
         st.session_state.user_id = create_or_ignore_user_id(cursor, "+14758374759")
         cursor.close()
 
-if any(isinstance(m, ErrorMessage) for m in st.session_state.messages):
+if st.session_state.error_message is not None:
     st.session_state.chat_input_disabled = True
 
 # Capture user input from chat input
@@ -78,15 +107,24 @@ with st.expander(label="Car Service Agent", expanded=st.session_state.expander_o
     st.write("Use this bot to schedule an appointment or ask a question about the service.")
     # st.markdown(":red[By scheduling an appointment you agree to store your data in our service until you decide to delete it.]")
 
-# Loop through all messages in the session state and render them as a chat on every st.rerun mech
-for msg in st.session_state.messages:
-    if isinstance(msg, ErrorMessage):
-        st.error(msg.content, icon="🚨")
-        st.stop()
-    elif isinstance(msg, AIMessage):
-        st.chat_message("assistant").write(msg.content)
-    elif isinstance(msg, HumanMessage):
-        st.chat_message("user").write(msg.content)
+# Collapse messages which left the window into pages of history, each message is formatted only once
+chat_log = st.session_state.chat_log
+while len(chat_log) - st.session_state.archived_count >= HISTORY_WINDOW + HISTORY_PAGE_SIZE:
+    page = chat_log[st.session_state.archived_count:st.session_state.archived_count + HISTORY_PAGE_SIZE]
+    st.session_state.history_pages.append("\n\n".join(f"**{role.capitalize()}:** {content}" for role, content in page))
+    st.session_state.archived_count += HISTORY_PAGE_SIZE
+
+# Render only one page of the collapsed history and the latest messages as a chat on every st.rerun mech
+if st.session_state.history_pages:
+    pages = st.session_state.history_pages
+    with st.expander(label=f"Earlier messages ({st.session_state.archived_count})"):
+        page_number = st.number_input("Page", min_value=1, max_value=len(pages), value=len(pages))
+        st.markdown(pages[page_number - 1])
+for role, content in chat_log[st.session_state.archived_count:]:
+    st.chat_message(role).write(content)
+if st.session_state.error_message is not None:
+    st.error(st.session_state.error_message, icon="🚨")
+    st.stop()
 
 # Handle user input if provided
 if prompt:
@@ -95,21 +133,31 @@ if prompt:
     except ValidationException as e:
         st.error(str(e), icon="🚨")
     else:
-        st.session_state.messages.append(HumanMessage(content=prompt))
+        add_message(HumanMessage(content=prompt))
         st.chat_message("user").write(prompt)
 
         with st.chat_message("assistant"):
             # Create a placeholder container for streaming and any other events to visually render here
             try:
                 placeholder = st.container()
-                response = asyncio.run(invoke_graph(st.session_state.messages, placeholder, st.session_state.user_id))
-                st.session_state.messages.append(AIMessage(response))
+                response = asyncio.run(invoke_graph(st.session_state.messages, placeholder, st.session_state.user_id,
+                                                    st.session_state.session_id))
+                add_message(AIMessage(response))
             except TokenExceededException as e:
-                st.session_state.messages.append(AIMessage(content=str(e.args[1])))
-                st.session_state.messages.append(ErrorMessage(content=str(e.args[0])))
+                if e.args[1]:  # the text streamed before the limit was reached (none if the check was pre-flight)
+                    add_message(AIMessage(content=str(e.args[1])))
+                add_message(ErrorMessage(content=str(e.args[0])))
                 st.rerun()
-            except Exception as e:
+            except ModelInvocationException as e:
                 print(e.args[0])
-                st.session_state.messages.append(AIMessage(content=str(e.args[1])))
-                st.session_state.messages.append(ErrorMessage(content="Something went wrong. Restart the conversation."))
+                if e.args[1]:
+                    add_message(AIMessage(content=str(e.args[1])))
+                add_message(ErrorMessage(content="The assistant is not available at the moment. Restart the "
+                                                 "conversation."))
+                st.rerun()
+            except Exception as e:
+                print(e)
+                if len(e.args) > 1 and e.args[1]:
+                    add_message(AIMessage(content=str(e.args[1])))
+                add_message(ErrorMessage(content="Something went wrong. Restart the conversation."))
                 st.rerun()
@@ -0,0 +1,778 @@
+"""
+Benchmarks of the agent's tool layer. Run with: python benchmarks.py <benchmark> [options]
+
+The benchmarks work on a temporary database, the service database is not touched.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from itertools import islice
+
+import graph
+import graph_events
+from migrations import migrate, LATEST_VERSION
+from seed_data import SEED_CHUNK_SIZE, generate_rows, seed_database
+from utility_func import (ActivityStatus, DATETIME_FORMAT, ValidationException, check_appointment_datetime,
+                          make_datetime_format_readable, to_day_ordinal, validate_batch, validate_datetime,
+                          validate_user_email_address, validate_user_phone_number, create_or_ignore_user_id,
+                          soft_delete_users)
+
+
+# -------------------------------------------------------- HELPERS
+def use_temporary_db() -> str:
+    """Point the tools to a new empty database in a temporary directory."""
+    db_file = os.path.join(tempfile.mkdtemp(), "benchmark.sqlite")
+    graph.create_db(db_file=db_file, db_backup_file=db_file + ".backup")
+    graph.db = db_file
+    return db_file
+
+
+def next_working_slot(days_ahead: int, hour: int = 10) -> tuple:
+    """Get the date and time of a working day slot at least days_ahead days from now."""
+    slot = datetime.now() + timedelta(days=days_ahead)
+    while slot.weekday() in [5, 6]:
+        slot += timedelta(days=1)
+    return slot.strftime("%Y-%m-%d"), f"{hour:02d}:00"
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def report(name: str, latencies: list) -> dict:
+    """Print and return latency statistics (in milliseconds) of the benchmark."""
+    latencies = sorted(latencies)
+    result = {
+        "name": name,
+        "runs": len(latencies),
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p95_ms": round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 3),
+        "throughput_per_s": round(len(latencies) / sum(latencies), 1),
+    }
+    print(json.dumps(result))
+    return result
+
+
+# -------------------------------------------------------- UPDATE
+def bench_update(runs: int) -> None:
+    """Output tokens and latency of user data updates with the patch API compared to rewriting the whole record."""
+    use_temporary_db()
+    user_id = "benchmark-user"
+    date, time_ = next_working_slot(days_ahead=7)
+    record = dict(user_name="John", user_surname="Doe", user_email="john.doe@example.com",
+                  user_phone_number="+14758374759", appointment_date=date, appointment_time=time_,
+                  appointment_problem="Strange noise from the engine", car_license_plate="7ABC123",
+                  car_manufacturer="Toyota", car_model="Corolla", car_year="2015")
+    print(graph.schedule_appointment_tool._run(user_id=user_id, **record))
+
+    new_date, _ = next_working_slot(days_ahead=14, hour=11)
+    patches = {
+        "email": lambda i: dict(user_email=f"john.doe{i}@example.com"),
+        # the appointment is moved back and forth between the two dates
+        "appointment": lambda i: dict(appointment_date=date if i % 2 else new_date,
+                                      previous_appointment_date=new_date if i % 2 else date,
+                                      appointment_problem=f"Strange noise #{i}"),
+        "car": lambda i: dict(car_model=f"Corolla {i}", previous_car_license_plate="7ABC123"),
+    }
+    for name, make_patch in patches.items():
+        # tokens of the tool call arguments the model has to generate, the old API required the whole record
+        patch_tokens = estimate_tokens(json.dumps(make_patch(0)))
+        full_record_tokens = estimate_tokens(json.dumps({**record, **make_patch(0), "previous_user_phone_number":
+                                                         record["user_phone_number"]}))
+        print(json.dumps({"name": f"update_{name}_output_tokens", "patch": patch_tokens,
+                          "full_record": full_record_tokens}))
+
+        latencies = []
+        for i in range(runs):
+            start = time.perf_counter()
+            result = graph.update_user_data_tool._run(user_id=user_id, **make_patch(i))
+            latencies.append(time.perf_counter() - start)
+            if "successfully" not in result:
+                raise RuntimeError(f"Update {name} failed: {result}")
+        report(f"update_{name}", latencies)
+
+
+# -------------------------------------------------------- MIGRATION
+# columns set by the tools from the clock or a random uuid, they differ between two runs of the same calls
+_NONDETERMINISTIC_COLUMNS = {"users": set(), "cars": {"id"}, "appointments": {"id", "car_id"}}
+
+
+def _table_columns(conn: sqlite3.Connection, table: str, schema: str = "main") -> list:
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def _seed_v1(db_file: str, users: int, now: datetime) -> None:
+    """Fill a version 1 database with the seed data (its columns of version 1, without the typed dates)."""
+    conn = sqlite3.connect(db_file)
+    migrate(conn, target_version=1)
+    inserts = {}
+    for table in ("users", "cars", "appointments"):
+        columns = _table_columns(conn, table)
+        names = ", ".join(f'"{c}"' for c in columns)
+        inserts[table] = (len(columns), f"INSERT INTO {table} ({names}) VALUES ({', '.join('?' * len(columns))})")
+    rows = generate_rows(users, cars_per_user=1, appointments_per_car=2, now=now)
+    while chunk := list(islice(rows, SEED_CHUNK_SIZE)):
+        with conn:
+            for table, (count, insert) in inserts.items():
+                conn.executemany(insert, [row[:count] for row_table, row in chunk if row_table == table])
+    conn.close()
+
+
+def _time_queries(conn: sqlite3.Connection, query: str, params: list) -> tuple:
+    """Run the query for each of the parameters, return the results and the total time."""
+    start = time.perf_counter()
+    results = [conn.execute(query, p).fetchall() for p in params]
+    return results, time.perf_counter() - start
+
+
+def _compare_tables(db_file: str, reference_file: str) -> None:
+    """Raise if the tables of the databases differ (without the columns set from the clock or a random uuid)."""
+    conn = sqlite3.connect(db_file)
+    conn.execute("ATTACH DATABASE ? AS reference", (reference_file,))
+    for table, excluded in _NONDETERMINISTIC_COLUMNS.items():
+        columns = _table_columns(conn, table)
+        if columns != _table_columns(conn, table, "reference"):
+            raise RuntimeError(f"The columns of {table} differ: {columns}")
+        compared = ", ".join(f'"{c}"' for c in columns if c not in excluded and not c.startswith("date_"))
+        for a, b in (("main", "reference"), ("reference", "main")):
+            row = conn.execute(f"SELECT {compared} FROM {a}.{table} EXCEPT SELECT {compared} FROM {b}.{table}"
+                               ).fetchone()
+            if row is not None:
+                raise RuntimeError(f"{table} of the {a} database has a row the {b} database has not: {row}")
+    # the typed dates of the seeded appointments (backfilled by the migration, computed by the seeding)
+    row = conn.execute("""
+    SELECT a.id FROM main.appointments a JOIN reference.appointments r ON a.id = r.id
+    WHERE a.datetime_epoch IS NOT r.datetime_epoch OR a.day_ordinal IS NOT r.day_ordinal
+       OR a.date_scheduled_epoch IS NOT r.date_scheduled_epoch
+    """).fetchone()
+    if row is not None:
+        raise RuntimeError(f"The typed dates of appointment {row[0]} differ.")
+    conn.close()
+
+
+def _compare_tools(db_file: str, reference_file: str, users: list) -> dict:
+    """
+    Run the same tool calls for each of the users on both databases and raise if a result differs. Returns the
+    latencies of the tools on the database.
+    """
+    with sqlite3.connect(reference_file) as conn:
+        scheduled = [conn.execute("SELECT datetime FROM appointments WHERE user_id = ? AND status = ? "
+                                  "ORDER BY datetime LIMIT 1", (user_id, ActivityStatus.SCHEDULED.value)).fetchone()
+                     for user_id, _ in users]
+    new_date, new_time = next_working_slot(days_ahead=20, hour=16)
+
+    def calls(i):
+        user_id, phone_number = users[i]
+        date, time_ = scheduled[i][0].split("T") if scheduled[i] else next_working_slot(days_ahead=3)
+        return [
+            ("CheckUserAppointmentDataTool", graph.check_user_appointment_data_tool._run, (user_id, phone_number), {}),
+            ("CheckDatetimeAvailabilityTool", graph.check_datetime_availability_tool._run, (date, time_), {}),
+            ("UpdateUserDataTool", graph.update_user_data_tool._run, (user_id,),
+             dict(user_email=f"migrated{i}@example.com", appointment_date=new_date, appointment_time=new_time,
+                  previous_appointment_date=date)),
+            ("CancelAppointmentTool", graph.cancel_appointment_tool._run, (user_id, new_date), {}),
+            ("ScheduleAppointmentTool", graph.schedule_appointment_tool._run,
+             (f"migrated-user-{i}", "John", "Doe", f"migrated.new{i}@example.com", f"+8{i:010d}", new_date,
+              f"{9 + i % 8:02d}:00", "Regular service", f"M{i:08d}", "Toyota", "Corolla", "2015"), {}),
+            ("CheckUserAppointmentDataTool", graph.check_user_appointment_data_tool._run, (user_id, phone_number), {}),
+            ("DeleteUserTool", graph.remove_user_tool._run, (user_id, phone_number), {}),
+        ]
+
+    latencies, succeeded = defaultdict(list), Counter()
+    for i in range(len(users)):
+        for name, run, args, kwargs in calls(i):
+            results = []
+            for file in (db_file, reference_file):
+                graph.db = file
+                start = time.perf_counter()
+                results.append(run(*args, **kwargs))
+                if file == db_file:
+                    latencies[name].append(time.perf_counter() - start)
+            if results[0] != results[1]:
+                raise RuntimeError(f"{name} of user {users[i][0]} returns {results[0]!r} on the migrated database "
+                                   f"and {results[1]!r} on the reference database.")
+            succeeded[name] += "successfully" in results[0]
+    for name in ("UpdateUserDataTool", "CancelAppointmentTool", "ScheduleAppointmentTool", "DeleteUserTool"):
+        if not succeeded[name]:
+            raise RuntimeError(f"No call of {name} succeeded, the writes were not compared.")
+    return latencies
+
+
+def bench_migration(rows: int, lookups: int) -> None:
+    """
+    Upgrade a seeded version 1 database, compare the date queries on text and on typed columns and check that the
+    tools return the same results on the upgraded database as on a database seeded at the latest version.
+    """
+    directory = tempfile.mkdtemp()
+    db_file, reference_file = os.path.join(directory, "migration.sqlite"), os.path.join(directory, "reference.sqlite")
+    users = max(1, rows // 2)
+    now = datetime.now().replace(second=0, microsecond=0)
+    _seed_v1(db_file, users, now)
+    seed_database(reference_file, users, now=now)
+    conn = sqlite3.connect(db_file)
+
+    rng = random.Random(1)
+    sample = [conn.execute("SELECT user_id, DATE(datetime) FROM appointments WHERE rowid = ?",
+                           (rng.randint(1, 2 * users),)).fetchone() for _ in range(lookups)]
+    user_days = [(user_id, day) for user_id, day in sample]
+    day_ranges = [(day, (datetime.strptime(day, "%Y-%m-%d") + timedelta(days=7)).strftime("%Y-%m-%d"))
+                  for _, day in sample[:10]]
+
+    text_queries = {
+        "user_day": ("SELECT id FROM appointments WHERE user_id = ? AND DATE(TRIM(datetime)) = ? ORDER BY id",
+                     user_days),
+        "day_range": ("SELECT COUNT(*) FROM appointments WHERE DATE(datetime) BETWEEN ? AND ?", day_ranges),
+    }
+    typed_queries = {
+        "user_day": ("SELECT id FROM appointments WHERE user_id = ? AND day_ordinal = ? ORDER BY id",
+                     [(user_id, to_day_ordinal(day)) for user_id, day in user_days]),
+        "day_range": ("SELECT COUNT(*) FROM appointments WHERE day_ordinal BETWEEN ? AND ?",
+                      [(to_day_ordinal(a), to_day_ordinal(b)) for a, b in day_ranges]),
+    }
+    text_results = {name: _time_queries(conn, *query) for name, query in text_queries.items()}
+
+    start = time.perf_counter()
+    version = migrate(conn)
+    migration_time = time.perf_counter() - start
+    if version != LATEST_VERSION:
+        raise RuntimeError(f"The database was migrated to version {version} instead of {LATEST_VERSION}.")
+    print(json.dumps({"name": "migration", "rows": rows, "version": version, "seconds": round(migration_time, 3)}))
+
+    for name, query in typed_queries.items():
+        typed_result, typed_time = _time_queries(conn, *query)
+        text_result, text_time = text_results[name]
+        if typed_result != text_result:
+            raise RuntimeError(f"Query {name} returns different results on the typed columns.")
+        print(json.dumps({"name": f"query_{name}", "queries": len(query[1]), "text_ms": round(text_time * 1000, 3),
+                          "typed_ms": round(typed_time * 1000, 3), "speedup": round(text_time / typed_time, 1)}))
+    conn.close()
+
+    _compare_tables(db_file, reference_file)
+    latencies = _compare_tools(db_file, reference_file, _sample_users(reference_file, min(lookups, users // 2), rng))
+    _compare_tables(db_file, reference_file)
+    for name, tool_latencies in latencies.items():
+        report(f"migrated_{name}", tool_latencies)
+    print(json.dumps({"name": "migration_tools", "users": min(lookups, users // 2), "same_results": True}))
+
+
+# -------------------------------------------------------- VALIDATION
+def _legacy_validate_datetime(date_time: str) -> None:
+    """Reference: the datetime validation before the validators were precompiled (parses the value three times)."""
+    make_datetime_format_readable.__wrapped__("%Y-%m-%dT%H:%M")
+    datetime.strptime(date_time, "%Y-%m-%dT%H:%M")
+    date, time_ = date_time.split("T")
+    datetime_datetime = datetime.combine(datetime.strptime(date, "%Y-%m-%d").date(),
+                                         datetime.strptime(time_, "%H:%M").time())
+    check_appointment_datetime(datetime_datetime, datetime.now())
+
+
+def _time_calls(function, values: list) -> float:
+    """Call the function with each of the values, return the time per call in microseconds."""
+    start = time.perf_counter()
+    for value in values:
+        try:
+            function(value)
+        except (ValidationException, ValueError):
+            pass
+    return (time.perf_counter() - start) / len(values) * 1e6
+
+
+def bench_validation(rows: int) -> None:
+    """Per-call time of the validators and the time per million rows of the batch validation."""
+    rng = random.Random(0)
+    date, time_ = next_working_slot(days_ahead=7)
+    datetimes = [f"{date}T{rng.choice([time_, '10:30', '19:00', '10:15'])}" for _ in range(rows)]
+    emails = [rng.choice(["john.doe@example.com", "invalid@", "a.b@c-d.io"]) for _ in range(rows)]
+    phone_numbers = [rng.choice(["+14758374759", "+1 475 837 4759", "14758374759", "+1475"]) for _ in range(rows)]
+
+    sample = min(rows, 100_000)
+    print(json.dumps({"name": "validate_datetime_per_call", "legacy_us": round(_time_calls(
+        _legacy_validate_datetime, datetimes[:sample]), 3), "us": round(_time_calls(validate_datetime,
+                                                                                     datetimes[:sample]), 3)}))
+    scalar_us = {
+        "datetimes": _time_calls(validate_datetime, datetimes[:sample]),
+        "emails": _time_calls(validate_user_email_address, emails[:sample]),
+        "phone_numbers": _time_calls(validate_user_phone_number, phone_numbers[:sample]),
+    }
+    columns = {"datetimes": datetimes, "emails": emails, "phone_numbers": phone_numbers}
+    for name, values in columns.items():
+        start = time.perf_counter()
+        codes = validate_batch(**{name: values})[name]
+        batch_seconds = time.perf_counter() - start
+        print(json.dumps({"name": f"validate_{name}", "rows": rows, "invalid": int((codes != 0).sum()),
+                          "scalar_s_per_million": round(scalar_us[name], 3),
+                          "batch_s_per_million": round(batch_seconds / rows * 1e6, 3),
+                          "speedup": round(scalar_us[name] / (batch_seconds / rows * 1e6), 1)}))
+
+
+# -------------------------------------------------------- TOOLS
+# number of appointments at each scale (each user has one car with two appointments)
+TOOL_BENCHMARK_SCALES = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+BENCHMARK_HISTORY_FILE = "benchmark_history.jsonl"
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _sample_users(db_file: str, count: int, rng: random.Random) -> list:
+    """Sample (user id, phone number) of distinct active users by random rowids (without replacement)."""
+    with sqlite3.connect(db_file) as conn:
+        max_rowid = conn.execute("SELECT MAX(rowid) FROM users").fetchone()[0]
+        active_users = conn.execute("SELECT COUNT(*) FROM users WHERE status = ?",
+                                    (ActivityStatus.ACTIVE.value,)).fetchone()[0]
+        if count > active_users:
+            raise ValueError(f"Cannot sample {count} of {active_users} active users.")
+        users, sampled_rowids = [], set()
+        while len(users) < count:
+            rowid = rng.randint(1, max_rowid)
+            if rowid in sampled_rowids:
+                continue
+            sampled_rowids.add(rowid)
+            row = conn.execute("SELECT id, phone_number FROM users WHERE rowid = ? AND status = ?",
+                               (rowid, ActivityStatus.ACTIVE.value)).fetchone()
+            if row is not None:
+                users.append(row)
+    return users
+
+
+def bench_tools(scale: str, runs: int, db_file: str | None, history_file: str) -> None:
+    """Latency and throughput of each tool's _run on a seeded database, appended to the benchmark history."""
+    if db_file is None:
+        db_file = os.path.join(tempfile.mkdtemp(), f"tools_{scale}.sqlite")
+    if not os.path.exists(db_file):
+        start = time.perf_counter()
+        counts = seed_database(db_file, users=TOOL_BENCHMARK_SCALES[scale] // 2)
+        print(json.dumps({"name": "seed", "scale": scale, **counts, "seconds": round(time.perf_counter() - start, 1)}))
+    graph.create_db(db_file=db_file, db_backup_file=db_file + ".backup")
+    graph.db = db_file
+
+    rng = random.Random(0)
+    users = _sample_users(db_file, 2 * runs, rng)
+    readers, writers = users[:runs], users[runs:]
+    date, time_ = next_working_slot(days_ahead=3)
+    new_date, _ = next_working_slot(days_ahead=10)
+
+    def lookup_user_id(i):
+        with sqlite3.connect(db_file) as conn:
+            return create_or_ignore_user_id(conn.cursor(), readers[i][1])
+
+    # name -> (case, check of the case's result), a failed call would time a cheaper path
+    cases = {
+        "create_or_ignore_user_id": (lookup_user_id, lambda result, i: result == readers[i][0]),
+        "CheckUserAppointmentDataTool": (lambda i: graph.check_user_appointment_data_tool._run(*readers[i]),
+                                         lambda result, i: not result.startswith(("User is not registered",
+                                                                                  "A system error"))),
+        "CheckDatetimeAvailabilityTool": (lambda i: graph.check_datetime_availability_tool._run(date, time_),
+                                          lambda result, i: result == "Valid date."),
+        "ScheduleAppointmentTool": (lambda i: graph.schedule_appointment_tool._run(
+            f"benchmark-user-{i}", "John", "Doe", f"benchmark{i}@example.com", f"+9{i:010d}", date, time_,
+            "Regular service", f"B{i:08d}", "Toyota", "Corolla", "2015"),
+                                    lambda result, i: "successfully" in result),
+        "UpdateUserDataTool": (lambda i: graph.update_user_data_tool._run(
+            f"benchmark-user-{i}", user_email=f"benchmark.updated{i}@example.com", appointment_date=new_date,
+            previous_appointment_date=date), lambda result, i: "successfully" in result),
+        "CancelAppointmentTool": (lambda i: graph.cancel_appointment_tool._run(f"benchmark-user-{i}", new_date),
+                                  lambda result, i: "successfully" in result),
+        "DeleteUserTool": (lambda i: graph.remove_user_tool._run(writers[i][0], writers[i][1]),
+                           lambda result, i: "successfully" in result),
+    }
+    results = []
+    for name, (case, check) in cases.items():
+        latencies = []
+        for i in range(runs):
+            start = time.perf_counter()
+            result = case(i)
+            latencies.append(time.perf_counter() - start)
+            if not check(result, i):
+                raise RuntimeError(f"{name} failed: {result}")
+        results.append(report(f"{name}_{scale}", latencies))
+
+    with open(history_file, "a") as f:
+        for result in results:
+            f.write(json.dumps({"revision": _git_revision(), "date": datetime.now().strftime(DATETIME_FORMAT),
+                                "scale": scale, **result}) + "\n")
+
+
+# -------------------------------------------------------- SELECTION
+# user's messages and the tools the model must get for them
+SELECTION_CASES = [
+    ("When are you open?", ["ServiceData"]),
+    ("I'd like to book a repair for tomorrow", ["ScheduleAppointmentTool"]),
+    ("Can I change my email address?", ["UpdateUserDataTool"]),
+    ("I want to modify my phone number", ["UpdateUserDataTool"]),
+    ("please edit my car details", ["UpdateUserDataTool"]),
+    ("I need to reschedule my appointment", ["UpdateUserDataTool", "CancelAppointmentTool"]),
+    ("move my appointment", ["UpdateUserDataTool", "CancelAppointmentTool"]),
+    ("Please forget everything you know about me", ["MoreTools"]),
+]
+
+
+def bench_selection(runs: int) -> None:
+    """Tools selected for the user's messages (the write tools stay reachable) and the latency of the selection."""
+    from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+    for text, expected_tools in SELECTION_CASES:
+        tool_names = graph.select_tools(graph.select_phases([HumanMessage(content=text)]))
+        if missing := [name for name in expected_tools if name not in tool_names]:
+            raise RuntimeError(f"{missing} not selected for {text!r}: {tool_names}")
+
+    # the model asks for every tool when the keywords missed the request
+    messages = [HumanMessage(content="Please forget everything you know about me"),
+                AIMessage(content="", tool_calls=[{"name": "MoreTools", "args": {}, "id": "call-1"}]),
+                ToolMessage(content=graph.more_tools(), tool_call_id="call-1")]
+    tool_names = graph.select_tools(graph.select_phases(messages))
+    if set(tool_names) != {t.name for t in graph.tools} - {"MoreTools"}:
+        raise RuntimeError(f"MoreTools did not make every tool available: {tool_names}")
+    print(json.dumps({"name": "tool_selection_cases", "checked": len(SELECTION_CASES) + 1}))
+
+    conversation = [HumanMessage(content=text) for text, _ in SELECTION_CASES] * 5
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        graph.select_tools(graph.select_phases(conversation))
+        latencies.append(time.perf_counter() - start)
+    report("tool_selection", latencies)
+
+
+# -------------------------------------------------------- DELETE
+def bench_delete(users: int, batch_size: int) -> None:
+    """Deleting a batch of users one by one (DeleteUserTool) compared to one bulk soft_delete_users transaction."""
+    db_file = os.path.join(tempfile.mkdtemp(), "delete.sqlite")
+    seed_database(db_file, users=users)
+    graph.create_db(db_file=db_file, db_backup_file=db_file + ".backup")
+    graph.db = db_file
+    rng = random.Random(0)
+    sampled = _sample_users(db_file, 2 * batch_size, rng)
+    one_by_one, bulk = sampled[:batch_size], [user_id for user_id, _ in sampled[batch_size:2 * batch_size]]
+
+    start = time.perf_counter()
+    for user_id, phone_number in one_by_one:
+        graph.remove_user_tool._run(user_id, phone_number)
+    print(json.dumps({"name": "DeleteUserTool", "users": len(one_by_one),
+                      "seconds": round(time.perf_counter() - start, 3)}))
+
+    start = time.perf_counter()
+    with sqlite3.connect(db_file) as conn:
+        deleted = soft_delete_users(conn.cursor(), bulk, datetime.now().strftime(DATETIME_FORMAT))
+    print(json.dumps({"name": "soft_delete_users", "users": deleted,
+                      "seconds": round(time.perf_counter() - start, 3)}))
+
+    # the denormalized statuses must match the referenced rows
+    with sqlite3.connect(db_file) as conn:
+        inconsistent = conn.execute("""
+        SELECT COUNT(*) FROM appointments a JOIN cars c ON c.id = a.car_id JOIN users u ON u.id = a.user_id
+        WHERE a.user_status != u.status OR a.car_status != c.status OR (c.status = ? AND a.status != ?)
+        """, (ActivityStatus.DELETED.value,) * 2).fetchone()[0]
+    print(json.dumps({"name": "inconsistent_appointments", "rows": inconsistent}))
+
+
+# -------------------------------------------------------- STREAM
+def _fake_streaming_graph(tokens: int):
+    """
+    Graph with one model node whose fake model streams a response of the given number of tokens, and the call of the
+    fake model alone (the baseline without the graph and the event stream).
+    """
+    from typing import Annotated, TypedDict
+    from langchain_core.language_models import GenericFakeChatModel
+    from langchain_core.messages import AIMessage
+    from langgraph.graph import StateGraph, START, END
+    from langgraph.graph.message import add_messages
+
+    class StreamState(TypedDict):
+        messages: Annotated[list, add_messages]
+        user_id: str
+
+    response = " ".join(f"token{i}" for i in range(tokens))
+
+    async def call_fake_model(messages: list, config=None) -> AIMessage:
+        model = GenericFakeChatModel(messages=iter([AIMessage(content=response)]))
+        # stream=True like the streaming=True chat model of the graph
+        return await model.ainvoke(messages, config, stream=True)
+
+    async def call_model(state: StreamState, config):
+        return {"messages": [await call_fake_model(state["messages"], config)]}
+
+    graph = StateGraph(StreamState)
+    graph.add_node(graph_events.MODEL_NODE, call_model)
+    graph.add_edge(START, graph_events.MODEL_NODE)
+    graph.add_edge(graph_events.MODEL_NODE, END)
+    return graph.compile(), call_fake_model
+
+
+async def _consume_astream_events(runnable, inputs: dict) -> str:
+    """The event loop of invoke_graph before the filtered stream (without the UI updates)."""
+    from langchain_core.messages import AIMessage
+    final_text, total_tokens_used = "", 0
+    async for event in runnable.astream_events(inputs, version="v2"):
+        if "output" in event["data"] and "messages" in event["data"]["output"]:
+            last_message = event["data"]["output"]["messages"][-1]
+            if isinstance(last_message, AIMessage) and last_message.usage_metadata:
+                total_tokens_used = max(total_tokens_used, last_message.usage_metadata["total_tokens"])
+        elif "input" in event["data"] and event["data"]["input"] and "messages" in event["data"]["input"]:
+            last_message = event["data"]["input"]["messages"][-1]
+            if isinstance(last_message, AIMessage) and last_message.usage_metadata:
+                total_tokens_used = max(total_tokens_used, last_message.usage_metadata["total_tokens"])
+        if event["event"] == "on_chat_model_stream":
+            final_text += event["data"]["chunk"].content
+    return final_text
+
+
+async def _consume_graph_events(runnable, inputs: dict) -> str:
+    final_text, total_tokens_used = "", 0
+    async for event in graph_events.stream_graph_events(runnable, inputs):
+        if event.kind == graph_events.TOKEN:
+            final_text += event.text
+        elif event.kind == graph_events.USAGE:
+            total_tokens_used = max(total_tokens_used, event.data)
+    return final_text
+
+
+def bench_stream(tokens: int, runs: int) -> None:
+    """Per-token overhead of the filtered graph event stream compared to the astream_events loop."""
+    import asyncio
+    from langchain_core.messages import HumanMessage
+    runnable, call_fake_model = _fake_streaming_graph(tokens)
+    inputs = {"messages": [HumanMessage(content="Hello")], "user_id": "benchmark-user"}
+
+    async def consume_baseline(_, inputs):
+        return (await call_fake_model(inputs["messages"])).content
+
+    baseline_ms = None
+    for name, consume in [("fake_model_only", consume_baseline), ("astream_events", _consume_astream_events),
+                          ("stream_graph_events", _consume_graph_events)]:
+        asyncio.run(consume(runnable, inputs))  # warm up
+        latencies = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            text = asyncio.run(consume(runnable, inputs))
+            latencies.append(time.perf_counter() - start)
+        assert len(text.split()) == tokens
+        p50_ms = report(name, latencies)["p50_ms"]
+        if baseline_ms is None:
+            baseline_ms = p50_ms
+        else:
+            print(json.dumps({"name": name, "tokens": tokens,
+                              "overhead_per_token_us": round((p50_ms - baseline_ms) / tokens * 1000, 2)}))
+
+# -------------------------------------------------------- HEDGE
+def _check_invocation_paths() -> None:
+    """Drive the ModelInvoker with injected latency and errors and check the paths which served the responses."""
+    import asyncio
+    from model_invocation import FakeChatModel, ModelInvocationException, ModelInvoker
+
+    async def invoke(invoker, *models):
+        return await invoker.ainvoke([(f"model{i}", model) for i, model in enumerate(models)], ["Hello"])
+
+    invoker = ModelInvoker(attempt_timeout_s=0.5, hedge_delay_default_s=0.05)
+    _, record = asyncio.run(invoke(invoker, FakeChatModel(latency_s=0.001), FakeChatModel()))
+    assert (record.path, record.attempt) == ("primary", 0), record
+
+    primary = FakeChatModel(latencies_s=(1.0, 0.001))  # the first request stalls, the hedged one is fast
+    _, record = asyncio.run(invoke(invoker, primary, FakeChatModel()))
+    assert (record.path, record.attempt, primary.calls) == ("hedge", 0, 2), record
+
+    no_hedge = ModelInvoker(attempt_timeout_s=0.05, hedge=False)
+    _, record = asyncio.run(invoke(no_hedge, FakeChatModel(latency_s=1.0), FakeChatModel()))
+    assert (record.path, record.attempt) == ("fallback", 1) and "TimeoutError" in record.errors[0], record
+
+    _, record = asyncio.run(invoke(invoker, FakeChatModel(error_rate=1.0), FakeChatModel()))
+    assert (record.path, record.attempt) == ("fallback", 1) and "Injected model error" in record.errors[0], record
+
+    try:
+        asyncio.run(invoke(invoker, FakeChatModel(error_rate=1.0), FakeChatModel(error_rate=1.0)))
+    except ModelInvocationException as e:
+        assert "All models failed" in e.args[0]
+    else:
+        raise AssertionError("ModelInvocationException was not raised.")
+    print(json.dumps({"name": "invocation_paths", "checked": ["primary", "hedge", "timeout", "error", "all_failed"]}))
+
+
+def _check_hedged_stream() -> None:
+    """A hedged response replaces the text the stalled primary request streamed through the graph."""
+    import asyncio
+    from langchain_core.messages import HumanMessage
+    from model_invocation import FakeChatModel, ModelInvoker
+
+    response = "The service is open Monday to Friday."
+    get_bound_llms, model_invoker = graph.get_bound_llms, graph.model_invoker
+    graph.get_bound_llms = lambda tool_names: (("primary", FakeChatModel(response=response,
+                                                                         latencies_s=(1.0, 0.001))),)
+    graph.model_invoker = ModelInvoker(attempt_timeout_s=2.0, hedge_delay_default_s=0.05)
+
+    async def collect():
+        inputs = {"messages": [HumanMessage(content="When are you open?")], "user_id": "benchmark-user"}
+        return [event async for event in graph_events.stream_graph_events(graph.graph_runnable, inputs)]
+
+    try:
+        events = asyncio.run(collect())
+    finally:
+        graph.get_bound_llms, graph.model_invoker = get_bound_llms, model_invoker
+    streamed = "".join(event.text for event in events if event.kind == graph_events.TOKEN)
+    message = next(event.data for event in events if event.kind == graph_events.MESSAGE)
+    assert streamed == response.split()[0], streamed  # the primary request stalled after the first word
+    assert message.response_metadata["served_by"]["path"] == "hedge" and message.content == response, message
+    print(json.dumps({"name": "hedged_stream", "streamed": streamed, "served": message.content}))
+
+
+def _fake_openai_server(response: str):
+    """Local HTTP server answering the streamed chat completions of the OpenAI API with the response (keep-alive)."""
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    def chunk(model, delta, finish_reason=None, usage=None):
+        choices = [] if usage else [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        return "data: " + json.dumps({"id": "chatcmpl-benchmark", "object": "chat.completion.chunk", "created": 0,
+                                      "model": model, "choices": choices, "usage": usage}) + "\n\n"
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            model = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["model"]
+            words = response.split(" ")
+            body = "".join([
+                chunk(model, {"role": "assistant", "content": ""}),
+                *(chunk(model, {"content": word if i == 0 else " " + word}) for i, word in enumerate(words)),
+                chunk(model, {}, finish_reason="stop"),
+                chunk(model, {}, usage={"prompt_tokens": 10, "completion_tokens": len(words),
+                                        "total_tokens": 10 + len(words)}),
+                "data: [DONE]\n\n",
+            ]).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _check_turns_on_new_event_loops() -> None:
+    """
+    The app runs every turn with asyncio.run, each turn has to be served by the primary model (a ChatOpenAI against
+    a local fake of the API) although the previous turn's event loop is closed.
+    """
+    import asyncio
+    from langchain_core.messages import HumanMessage
+
+    response = "The service is open Monday to Friday."
+    server = _fake_openai_server(response)
+    environ = {"OPENAI_API_BASE": f"http://127.0.0.1:{server.server_port}/v1", "OPENAI_API_KEY": "benchmark"}
+    saved_environ = {name: os.environ.get(name) for name in environ}
+    os.environ.update(environ)
+
+    async def turn():
+        inputs = {"messages": [HumanMessage(content="When are you open?")], "user_id": "benchmark-user"}
+        return [event async for event in graph_events.stream_graph_events(graph.graph_runnable, inputs)]
+
+    try:
+        paths = []
+        for _ in range(2):
+            message = next(event.data for event in asyncio.run(turn()) if event.kind == graph_events.MESSAGE)
+            served_by = message.response_metadata["served_by"]
+            if served_by["path"] != "primary" or message.content != response:
+                raise RuntimeError(f"Turn {len(paths)} was not served by the primary model: {served_by}")
+            paths.append(served_by["path"])
+    finally:
+        server.shutdown()
+        for name, value in saved_environ.items():
+            if value is None:
+                os.environ.pop(name)
+            else:
+                os.environ[name] = value
+    print(json.dumps({"name": "turns_on_new_event_loops", "paths": paths}))
+
+
+def bench_hedge(runs: int) -> None:
+    """Deadline, hedge and fallback paths of the model invocation and the tail latency with and without hedging."""
+    import asyncio
+    from model_invocation import FakeChatModel, ModelInvoker
+    use_temporary_db()
+    _check_invocation_paths()
+    _check_hedged_stream()
+    _check_turns_on_new_event_loops()
+
+    # every tenth request stalls
+    latencies_s = tuple(0.5 if i % 10 == 9 else 0.01 for i in range(2 * runs))
+    for name, invoker in [("no_hedge", ModelInvoker(hedge=False)),
+                          ("hedge", ModelInvoker(hedge_delay_default_s=0.05, hedge_min_samples=runs + 1))]:
+        primary = FakeChatModel(latencies_s=latencies_s)
+        latencies, paths = [], Counter()
+        for _ in range(runs):
+            start = time.perf_counter()
+            _, record = asyncio.run(invoker.ainvoke([("primary", primary)], ["Hello"]))
+            latencies.append(time.perf_counter() - start)
+            paths[record.path] += 1
+        report(f"model_invocation_{name}", latencies)
+        print(json.dumps({"name": f"model_invocation_{name}", "paths": dict(paths)}))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    update_parser = subparsers.add_parser("update", help=bench_update.__doc__)
+    update_parser.add_argument("--runs", type=int, default=200)
+
+    migration_parser = subparsers.add_parser("migration", help=bench_migration.__doc__)
+    migration_parser.add_argument("--rows", type=int, default=2_000_000)
+    migration_parser.add_argument("--lookups", type=int, default=100)
+
+    validation_parser = subparsers.add_parser("validation", help=bench_validation.__doc__)
+    validation_parser.add_argument("--rows", type=int, default=1_000_000)
+
+    tools_parser = subparsers.add_parser("tools", help=bench_tools.__doc__)
+    tools_parser.add_argument("--scale", choices=TOOL_BENCHMARK_SCALES, default="10k")
+    tools_parser.add_argument("--runs", type=int, default=200)
+    tools_parser.add_argument("--db", help="Seeded database to reuse (seeded if it does not exist)")
+    tools_parser.add_argument("--history", default=BENCHMARK_HISTORY_FILE)
+
+    selection_parser = subparsers.add_parser("selection", help=bench_selection.__doc__)
+    selection_parser.add_argument("--runs", type=int, default=1_000)
+
+    delete_parser = subparsers.add_parser("delete", help=bench_delete.__doc__)
+    delete_parser.add_argument("--users", type=int, default=500_000)
+    delete_parser.add_argument("--batch-size", type=int, default=1_000)
+
+    stream_parser = subparsers.add_parser("stream", help=bench_stream.__doc__)
+    stream_parser.add_argument("--tokens", type=int, default=500)
+    stream_parser.add_argument("--runs", type=int, default=20)
+
+    hedge_parser = subparsers.add_parser("hedge", help=bench_hedge.__doc__)
+    hedge_parser.add_argument("--runs", type=int, default=100)
+
+    args = parser.parse_args()
+    if args.benchmark == "update":
+        bench_update(args.runs)
+    elif args.benchmark == "migration":
+        bench_migration(args.rows, args.lookups)
+    elif args.benchmark == "validation":
+        bench_validation(args.rows)
+    elif args.benchmark == "tools":
+        bench_tools(args.scale, args.runs, args.db, args.history)
+    elif args.benchmark == "selection":
+        bench_selection(args.runs)
+    elif args.benchmark == "delete":
+        bench_delete(args.users, args.batch_size)
+    elif args.benchmark == "stream":
+        bench_stream(args.tokens, args.runs)
+    elif args.benchmark == "hedge":
+        bench_hedge(args.runs)
@@ -0,0 +1,180 @@
+"""
+Profiling of the database statements run by the tools.
+
+Tools open their connections with connect(db_file, tool_name). When profiling is disabled (the default) this is a
+plain sqlite3 connection, so the profiler costs nothing. When enabled (PROFILE_QUERIES=1 environment variable or
+profiler.enabled = True) every statement's latency (execution and fetching), returned and affected rows and the number
+of executed virtual machine steps (a proxy for the rows scanned) are recorded together with the calling tool.
+Statements slower than the threshold are written with their EXPLAIN QUERY PLAN to the slow_query_log table once the
+tool's transaction ends.
+"""
+import os
+import sqlite3
+import time
+from collections import deque, defaultdict
+from datetime import datetime
+from typing import NamedTuple
+
+SLOW_QUERY_THRESHOLD_MS = 50.0
+# the progress handler is called every PROGRESS_STEPS virtual machine instructions
+PROGRESS_STEPS = 100
+
+
+class StatementProfile(NamedTuple):
+    tool: str
+    statement: str
+    latency_ms: float
+    rows_returned: int
+    rows_affected: int
+    vm_steps: int
+    query_plan: str | None
+
+
+class QueryProfiler:
+    """Collects profiles of the executed statements (the latest history_size of them)."""
+
+    def __init__(self, enabled: bool = False, slow_query_threshold_ms: float = SLOW_QUERY_THRESHOLD_MS,
+                 history_size: int = 10_000) -> None:
+        self.enabled = enabled
+        self.slow_query_threshold_ms = slow_query_threshold_ms
+        self.profiles = deque(maxlen=history_size)
+
+    def summary(self) -> list:
+        """Aggregate the profiles by tool and statement, the slowest statements (by total time) first."""
+        groups = defaultdict(list)
+        for profile in self.profiles:
+            groups[(profile.tool, profile.statement)].append(profile)
+        summary = [{
+            "tool": tool,
+            "statement": statement,
+            "calls": len(profiles),
+            "total_ms": round(sum(p.latency_ms for p in profiles), 3),
+            "max_ms": round(max(p.latency_ms for p in profiles), 3),
+            "rows_returned": sum(p.rows_returned for p in profiles),
+            "vm_steps": sum(p.vm_steps for p in profiles),
+        } for (tool, statement), profiles in groups.items()]
+        return sorted(summary, key=lambda s: s["total_ms"], reverse=True)
+
+
+profiler = QueryProfiler(enabled=os.environ.get("PROFILE_QUERIES") == "1")
+
+
+class _Measurement:
+    """Measurement of one executed statement, completed while its rows are fetched."""
+    __slots__ = ("statement", "parameters", "seconds", "vm_steps", "rows_returned", "rows_affected")
+
+    def __init__(self, statement: str, parameters) -> None:
+        self.statement = statement
+        self.parameters = parameters
+        self.seconds = 0.0
+        self.vm_steps = 0
+        self.rows_returned = 0
+        self.rows_affected = 0
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    def _measure(self, function, *args):
+        connection = self.connection
+        connection.vm_steps = 0
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self._measurement.seconds += time.perf_counter() - start
+            self._measurement.vm_steps += connection.vm_steps * PROGRESS_STEPS
+
+    def execute(self, sql, parameters=()):
+        self._measurement = _Measurement(sql, parameters)
+        self.connection.measurements.append(self._measurement)
+        self._measure(super().execute, sql, parameters)
+        self._measurement.rows_affected = max(self.rowcount, 0)
+        return self
+
+    def fetchone(self):
+        row = self._measure(super().fetchone)
+        self._measurement.rows_returned += row is not None
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._measure(super().fetchmany, size or self.arraysize)
+        self._measurement.rows_returned += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._measure(super().fetchall)
+        self._measurement.rows_returned += len(rows)
+        return rows
+
+
+class ProfilingConnection(sqlite3.Connection):
+    """Connection whose cursors are profiled, the profiles are collected when a transaction ends (with conn:)."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.tool_name = ""
+        self.measurements = []
+        self.vm_steps = 0
+        self.set_progress_handler(self._count_steps, PROGRESS_STEPS)
+
+    def _count_steps(self) -> int:
+        self.vm_steps += 1
+        return 0  # continue the execution
+
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        result = super().__exit__(exc_type, exc_value, traceback)
+        self.collect_profiles()
+        return result
+
+    def _query_plan(self, measurement: _Measurement) -> str | None:
+        try:
+            plan = super().execute(f"EXPLAIN QUERY PLAN {measurement.statement}", measurement.parameters).fetchall()
+        except sqlite3.Error:
+            return None
+        return "; ".join(row[-1] for row in plan)
+
+    def collect_profiles(self) -> None:
+        """Record the measured statements, write the slow ones to the slow query log."""
+        measurements, self.measurements = self.measurements, []
+        slow_profiles = []
+        for measurement in measurements:
+            latency_ms = measurement.seconds * 1000
+            is_slow = latency_ms >= profiler.slow_query_threshold_ms
+            profile = StatementProfile(
+                tool=self.tool_name,
+                statement=" ".join(measurement.statement.split()),
+                latency_ms=latency_ms,
+                rows_returned=measurement.rows_returned,
+                rows_affected=measurement.rows_affected,
+                vm_steps=measurement.vm_steps,
+                query_plan=self._query_plan(measurement) if is_slow else None,
+            )
+            profiler.profiles.append(profile)
+            if is_slow:
+                slow_profiles.append(profile)
+
+        if slow_profiles:
+            now = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+            try:
+                super().executemany("""
+                INSERT INTO slow_query_log (tool, "statement", latency_ms, rows_returned, rows_affected, vm_steps,
+                 query_plan, date_logged)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, [(*profile, now) for profile in slow_profiles])
+                super().commit()
+            except sqlite3.Error as e:
+                print(e)
+
+
+def connect(db_file: str, tool_name: str) -> sqlite3.Connection:
+    """Connect to the database on behalf of the tool, profiled if the profiler is enabled."""
+    if not profiler.enabled:
+        return sqlite3.connect(db_file)
+    conn = sqlite3.connect(db_file, factory=ProfilingConnection)
+    conn.tool_name = tool_name
+    return conn
@@ -1,17 +1,29 @@
 from langgraph.prebuilt import ToolNode, InjectedState
 from langchain_openai import ChatOpenAI
-from langgraph.graph import StateGraph, START
+from openai import DefaultAsyncHttpxClient
+from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
-from langchain_core.tools import Tool, BaseTool
+from langchain_core.tools import Tool, BaseTool, StructuredTool
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langchain_core.runnables import RunnableConfig
 
-from typing import Annotated, Literal
+from typing import Annotated, Literal, Optional
 from typing_extensions import TypedDict
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings
 
 import os
+import re
+import asyncio
+import json
+import time
 import sqlite3
 import shutil
+from functools import lru_cache
+from migrations import migrate
+from db_profiler import connect as connect_db
+from model_invocation import ModelInvoker
 from utility_func import *
 
 
@@ -27,60 +39,9 @@ def create_db(db_file, db_backup_file) -> None:
     if not db_exists:
         with open(db_file, 'w'): pass
     conn = sqlite3.connect(db_file)
-    with conn:
-        cursor = conn.cursor()
-
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id TEXT NOT NULL PRIMARY KEY,
-            "name" TEXT NOT NULL,
-            surname TEXT NOT NULL,
-            email VARCHAR(320) NOT NULL UNIQUE,
-            phone_number VARCHAR(15) NOT NULL UNIQUE,
-            status VARCHAR(7) NOT NULL,
-            date_registered VARCHAR(19) NOT NULL,
-            date_updated VARCHAR(19),
-            date_deleted VARCHAR(19)
-        )
-        """)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS cars (
-            id TEXT NOT NULL PRIMARY KEY,
-            license_plate VARCHAR(12) NOT NULL UNIQUE,
-            manufacturer TEXT NOT NULL,
-            model TEXT NOT NULL,
-            "year" INTEGER NOT NULL,
-            status VARCHAR(7) NOT NULL,
-            user_id TEXT NOT NULL,
-            user_status VARCHAR(7) NOT NULL,
-            date_registered VARCHAR(19) NOT NULL,
-            date_updated VARCHAR(19),
-            date_deleted VARCHAR(19),
-            FOREIGN KEY(user_id) REFERENCES users(id),
-            FOREIGN KEY(user_status) REFERENCES users(status)
-        )
-        """)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS appointments (
-            id TEXT NOT NULL PRIMARY KEY,
-            "datetime" VARCHAR(17) NOT NULL,
-            problem TEXT NOT NULL,
-            status VARCHAR(10) NOT NULL,
-            user_id TEXT NOT NULL,
-            user_status VARCHAR(7) NOT NULL,
-            car_id TEXT NOT NULL,
-            car_status VARCHAR(7) NOT Null,
-            date_scheduled VARCHAR(19) NOT NULL,
-            date_canceled VARCHAR(19),
-            date_updated VARCHAR(19),
-            date_deleted VARCHAR(19),
-            FOREIGN KEY(user_id) REFERENCES users(id),
-            FOREIGN KEY(user_status) REFERENCES users(status),
-            FOREIGN KEY(car_id) REFERENCES cars(id),
-            FOREIGN KEY(car_status) REFERENCES cars(status)
-        )
-        """)
-        cursor.close()
+    # create or upgrade the schema
+    migrate(conn)
+    conn.close()
 
     if not os.path.exists(db_backup_file):
         shutil.copy(db_file, db_backup_file)
@@ -138,13 +99,13 @@ class ScheduleAppointmentTool(BaseTool, BaseSettings):
             if user_id is None:
                 raise Exception("No user_id in State.")
             # connect to database
-            conn = sqlite3.connect(db)
+            conn = connect_db(db, self.name)
             with conn:
                 cursor = conn.cursor()
                 # check if an appointment at the given date already exists
                 cursor.execute(f"""SELECT DATE(datetime) FROM appointments WHERE (
-                user_id = ? AND DATE(TRIM(datetime)) = ? AND {DELETED_STATUS_QUERY_APPOINTMENT_TABLE})""",
-                               (user_id, appointment_date) + INVALID_APPOINTMENT_TABLE_STATUSES)
+                user_id = ? AND day_ordinal = ? AND {DELETED_STATUS_QUERY_APPOINTMENT_TABLE})""",
+                               (user_id, to_day_ordinal(appointment_date)) + INVALID_APPOINTMENT_TABLE_STATUSES)
                 if (_date := cursor.fetchone()) is not None:
                     return f"An appointment with the same date ({_date[0]}) already exists. You can make make only one appointment a day."
 
@@ -189,102 +150,118 @@ class ScheduleAppointmentTool(BaseTool, BaseSettings):
 
 class UpdateUserDataInputSchema(BaseModel):
     user_id: Annotated[str, InjectedState("user_id")]
-    user_name: str = Field(description="New user name")
-    user_surname: str = Field(description="New user surname")
-    user_email: str = Field(description="New user email address")
-    user_phone_number: str = Field(description="New user phone number (format: +#############)")
-    appointment_date: str = Field(description=f"New appointment date (format: {DATE_FORMAT})")
-    appointment_time: str = Field(description=f"New appointment time (format {TIME_FORMAT})")
-    appointment_problem: str = Field(description="New appointment problem")
-    car_license_plate: str = Field(description="New car licence plate")
-    car_manufacturer: str = Field(description="New car manufacturer")
-    car_model: str = Field(description="New car model")
-    car_year: str = Field(description="New car year")
-    previous_user_phone_number: str = Field(description="Previous user phone number")
-    previous_appointment_date: str = Field(description="Previous appointment date")
-    previous_car_license_plate: str = Field(description="Previous car licence plate")
+    user_name: Optional[str] = Field(default=None, description="New user name")
+    user_surname: Optional[str] = Field(default=None, description="New user surname")
+    user_email: Optional[str] = Field(default=None, description="New user email address")
+    user_phone_number: Optional[str] = Field(default=None, description="New user phone number (format: +#############)")
+    appointment_date: Optional[str] = Field(default=None, description=f"New appointment date (format: {DATE_FORMAT})")
+    appointment_time: Optional[str] = Field(default=None, description=f"New appointment time (format {TIME_FORMAT})")
+    appointment_problem: Optional[str] = Field(default=None, description="New appointment problem")
+    car_license_plate: Optional[str] = Field(default=None, description="New car licence plate")
+    car_manufacturer: Optional[str] = Field(default=None, description="New car manufacturer")
+    car_model: Optional[str] = Field(default=None, description="New car model")
+    car_year: Optional[str] = Field(default=None, description="New car year")
+    previous_appointment_date: Optional[str] = Field(
+        default=None, description="Date of the appointment to update (only when updating the appointment)")
+    previous_car_license_plate: Optional[str] = Field(
+        default=None, description="Licence plate of the car to update (only when updating the car)")
 
 
 class UpdateUserDataTool(BaseTool, BaseSettings):
     name: str = "UpdateUserDataTool"
-    description: str = f"Update the user’s personal info, appointment details, and/or car info."
+    description: str = (f"Update the user’s personal info, appointment details, and/or car info. "
+                        f"Pass only the fields that change.")
     args_schema: object = UpdateUserDataInputSchema
 
-    def _run(self, user_id: Annotated[str, InjectedState("user_id")], user_name: str, user_surname: str, user_email: str, user_phone_number: str,
-             appointment_date: str, appointment_time: str, appointment_problem: str, car_license_plate: str,
-             car_manufacturer: str, car_model: str, car_year: str, previous_user_phone_number: str,
-             previous_appointment_date: str, previous_car_license_plate: str) -> str:
+    def _run(self, user_id: Annotated[str, InjectedState("user_id")], user_name: Optional[str] = None,
+             user_surname: Optional[str] = None, user_email: Optional[str] = None,
+             user_phone_number: Optional[str] = None, appointment_date: Optional[str] = None,
+             appointment_time: Optional[str] = None, appointment_problem: Optional[str] = None,
+             car_license_plate: Optional[str] = None, car_manufacturer: Optional[str] = None,
+             car_model: Optional[str] = None, car_year: Optional[str] = None,
+             previous_appointment_date: Optional[str] = None, previous_car_license_plate: Optional[str] = None) -> str:
         """Run the tool."""
-        appointment_datetime = "T".join([appointment_date, appointment_time])
+        # requested changes by table (column -> new value), fields which were not provided are left unchanged
+        user_patch = get_patch(name=user_name, surname=user_surname, email=user_email, phone_number=user_phone_number)
+        appointment_patch = get_patch(date=appointment_date, time=appointment_time, problem=appointment_problem)
+        car_patch = get_patch(license_plate=car_license_plate, manufacturer=car_manufacturer, model=car_model,
+                              year=car_year)
+        if not (user_patch or appointment_patch or car_patch):
+            return "No data to update was provided."
+        if appointment_patch and previous_appointment_date is None:
+            return "Error: previous appointment date is required to update the appointment."
+        if car_patch and previous_car_license_plate is None:
+            return "Error: previous car licence plate is required to update the car."
         try:
             # validate data
-            check_missing_data(
-                user_name, user_surname, user_email, user_phone_number, appointment_datetime,
-                appointment_problem, car_license_plate, car_manufacturer, car_model, car_year)
-            validate_datetime(appointment_datetime)
-            validate_user_email_address(user_email)
-            validate_user_phone_number(user_phone_number)
+            if appointment_patch:
+                previous_appointment_day = to_day_ordinal(previous_appointment_date)
+            if "email" in user_patch:
+                validate_user_email_address(user_patch["email"])
+            if "phone_number" in user_patch:
+                validate_user_phone_number(user_patch["phone_number"])
         except ValidationException as e:
             return f"Error: {str(e)}."
         try:
             if user_id is None:
                 raise Exception("No user_id in State.")
             # connect to database
-            conn = sqlite3.connect(db)
+            conn = connect_db(db, self.name)
             with conn:
                 cursor = conn.cursor()
 
-                # GET IDs
-                # get appointment_id by user_id
-                cursor.execute(f"""
-                SELECT id FROM appointments WHERE (user_id = ? AND DATE(datetime) = ? AND {DELETED_STATUS_QUERY_APPOINTMENT_TABLE})  
-                """, (user_id, previous_appointment_date) + INVALID_APPOINTMENT_TABLE_STATUSES)
-                appointment_id = cursor.fetchone()[0]
-
-                # get car_id by user_id
-                cursor.execute(f"""
-                SELECT id FROM cars WHERE (user_id = ? AND license_plate = ? AND {DELETED_STATUS_QUERY_CAR_TABLE})
-                """, (user_id, previous_car_license_plate) + INVALID_CAR_TABLE_STATUSES)
-                car_id = cursor.fetchone()[0]
-
-                if appointment_id is None or car_id is None:
-                    return "No user found."
-
-                # UPDATE DATA
-                now = datetime.now().strftime(DATETIME_FORMAT)
-
-                # user data
-                cursor.execute(f"""
-                    UPDATE users
-                    SET name = ?, surname = ?, email = ?, phone_number = ?, date_updated = ?
+                # GET CURRENT DATA (with the row versions the updates are guarded by)
+                user_row = appointment_row = car_row = None
+                if user_patch:
+                    cursor.execute(f"""
+                    SELECT id, name, surname, email, phone_number, version FROM users 
                     WHERE (id = ? AND {DELETED_STATUS_QUERY_USER_TABLE})
-                """, (user_name, user_surname, user_email, user_phone_number, now, user_id)
-                               + INVALID_USER_TABLE_STATUSES)
-                if cursor.rowcount == 0:
-                    return "No users found."
-
-                # appointment data
-                cursor.execute(f"""
-                UPDATE appointments 
-                SET datetime = ?, problem = ?, date_updated = ?
-                WHERE (id = ? AND {DELETED_STATUS_QUERY_APPOINTMENT_TABLE})
-                """, (appointment_datetime, appointment_problem, now, appointment_id) + INVALID_APPOINTMENT_TABLE_STATUSES)
-                if cursor.rowcount == 0:
-                    return "No appointments found."
-
-                # car data
-                cursor.execute(f"""
-                UPDATE cars 
-                SET license_plate = ?, manufacturer = ?, model = ?, year = ?, date_updated = ?
-                WHERE (id = ? AND {DELETED_STATUS_QUERY_CAR_TABLE})
-                """, (car_license_plate, car_manufacturer, car_model, car_year, now, car_id) + INVALID_CAR_TABLE_STATUSES)
-                if cursor.rowcount == 0:
-                    return "No cars found."
-
+                    """, (user_id,) + INVALID_USER_TABLE_STATUSES)
+                    if (user_row := fetchone_as_dict(cursor)) is None:
+                        return "No users found."
+
+                if appointment_patch:
+                    cursor.execute(f"""
+                    SELECT id, datetime, problem, version FROM appointments 
+                    WHERE (user_id = ? AND day_ordinal = ? AND {DELETED_STATUS_QUERY_APPOINTMENT_TABLE})
+                    """, (user_id, previous_appointment_day) + INVALID_APPOINTMENT_TABLE_STATUSES)
+                    if (appointment_row := fetchone_as_dict(cursor)) is None:
+                        return "No appointments found."
+                    # the appointment datetime is stored as one column, combine the new date or time with the current
+                    current_date, current_time = appointment_row["datetime"].strip().split("T")
+                    new_date = appointment_patch.pop("date", current_date)
+                    new_time = appointment_patch.pop("time", current_time)
+                    if (new_date, new_time) != (current_date, current_time):
+                        appointment_patch["datetime"] = "T".join([new_date, new_time])
+                        try:
+                            validate_datetime(appointment_patch["datetime"])
+                        except ValidationException as e:
+                            return f"Error: {str(e)}."
+
+                if car_patch:
+                    cursor.execute(f"""
+                    SELECT id, license_plate, manufacturer, model, "year", version FROM cars 
+                    WHERE (user_id = ? AND license_plate = ? AND {DELETED_STATUS_QUERY_CAR_TABLE})
+                    """, (user_id, previous_car_license_plate) + INVALID_CAR_TABLE_STATUSES)
+                    if (car_row := fetchone_as_dict(cursor)) is None:
+                        return "No cars found."
+
+                # UPDATE DATA (only the changed columns, one statement per touched table)
+                now = datetime.now().strftime(DATETIME_FORMAT)
+                updated = False
+                for table, row, patch in (("users", user_row, user_patch),
+                                          ("appointments", appointment_row, appointment_patch),
+                                          ("cars", car_row, car_patch)):
+                    if row is not None:
+                        updated |= patch_row(cursor, table, row, patch, now)
                 cursor.close()
+        except ConcurrentUpdateException:
+            return "User data was changed in the meantime. Check the user data and try again."
         except Exception as e:
             print(e)
             return "A system error occurred while updating user data."
+        if not updated:
+            return "User data is already up to date."
         return "User data updated successfully."
 
 
@@ -325,7 +302,7 @@ class CheckUserAppointmentDataTool(BaseTool):
             if user_id is None:
                 raise Exception("No user_id in State.")
             # connect to the database
-            conn = sqlite3.connect(db)
+            conn = connect_db(db, self.name)
             with conn:
                 cursor = conn.cursor()
 
@@ -440,26 +417,25 @@ class CancelAppointmentTool(BaseTool):
     def _run(self, user_id: Annotated[str, InjectedState("user_id")], appointment_date: str) -> str:
         """Run the tool."""
         now = str(datetime.now().strftime(DATETIME_FORMAT))
+        try:
+            appointment_day = to_day_ordinal(appointment_date)
+        except ValidationException as e:
+            return f"Error: {str(e)}"
         try:
             # User id
             if not user_id:
                 raise Exception("User ID is missing.")
 
             # cancel appointment
-            conn = sqlite3.connect(db)
+            conn = connect_db(db, self.name)
             with conn:
                 cursor = conn.cursor()
 
                 cursor.execute(f"""
-                SELECT 1 FROM appointments 
-                WHERE (user_id = ? AND DATE(date_scheduled) = ? AND {DELETED_STATUS_QUERY_APPOINTMENT_TABLE})
-                """, (user_id, appointment_date) + INVALID_APPOINTMENT_TABLE_STATUSES)
-
-                cursor.execute(f"""
-                    UPDATE appointments SET status = ?, date_canceled = ? 
-                    WHERE (user_id = ? AND DATE(datetime) = ? AND {DELETED_STATUS_QUERY_APPOINTMENT_TABLE})
+                    UPDATE appointments SET status = ?, date_canceled = ?, version = version + 1 
+                    WHERE (user_id = ? AND day_ordinal = ? AND {DELETED_STATUS_QUERY_APPOINTMENT_TABLE})
                     """, (ActivityStatus.CANCELED.value, now, user_id,
-                          appointment_date) + INVALID_APPOINTMENT_TABLE_STATUSES)
+                          appointment_day) + INVALID_APPOINTMENT_TABLE_STATUSES)
                 if cursor.rowcount == 0:
                     return "No appointments with such user or appointment credentials were found."
                 cursor.close()
@@ -480,7 +456,7 @@ class DeleteUserTool(BaseTool):
     automatically). By removing a user, you erase all information associated with them from the service, including 
     their registered cars and scheduled appointments. This action cannot be undone. Note: this does not erase only
     specific information (eg. only cars), but everything: user, their car and appointment!"""
-    arg_schema: object = DeleteUserInputSchema
+    args_schema: object = DeleteUserInputSchema
 
     def _run(self, user_id: Annotated[str, InjectedState("user_id")], phone_number: str) -> str:
         """Run the tool."""
@@ -490,31 +466,25 @@ class DeleteUserTool(BaseTool):
             if not user_id:
                 raise Exception("User ID is missing.")
 
-            # delete user
-            conn = sqlite3.connect(local_file)
+            # delete user (their cars and appointments are deleted by the database triggers)
+            conn = connect_db(db, self.name)
             with conn:
                 cursor = conn.cursor()
-                deleted_status = ActivityStatus.DELETED.value
-
-                cursor.execute(f"""UPDATE appointments SET status = ?, date_deleted = ? WHERE user_id = ?""",
-                               (deleted_status, now, user_id))
-                if cursor.rowcount == 0:
-                    raise Exception("No appointments with such user_id found.")
-                cursor.execute(f"""UPDATE cars SET status = ?, date_deleted = ? WHERE user_id = ?""",
-                               (deleted_status, now, user_id))
-                if cursor.rowcount == 0:
-                    raise Exception("No cars with such user_id found.")
-                cursor.execute(f"""UPDATE users SET status = ?, date_deleted = ? WHERE id = ?""",
-                               (deleted_status, now, user_id))
-                if cursor.rowcount == 0:
-                    raise Exception("No users with such user_id found.")
+                deleted_users = soft_delete_users(cursor, [user_id], now)
                 cursor.close()
         except Exception as e:
             print(e)
             return "Some error occurred while deleting user data. If this continues, you should request human assistance."
+        if deleted_users == 0:
+            return "No data is stored for this user."
         return "User removed successfully."
 
 
+def more_tools():
+    """Makes all the tools available (the next model call binds every tool)."""
+    return "All the tools are available now."
+
+
 def service_data():
     """Gets data about the service (working hours, location)."""
     return """
@@ -536,16 +506,143 @@ service_data_tool = Tool(
     handle_tool_error=True
 )
 
+more_tools_tool = StructuredTool.from_function(
+    func=more_tools,
+    name="MoreTools",
+    description="Make all the tools available. Use this when the user's request needs a tool which is not available, "
+                "e.g. to check, change, reschedule or cancel their appointment, to change their data or to delete them.",
+    handle_tool_error=True
+)
+
 
 tools = [schedule_appointment_tool, update_user_data_tool, cancel_appointment_tool, check_user_appointment_data_tool,
-         check_datetime_availability_tool, service_data_tool, remove_user_tool]
+         check_datetime_availability_tool, service_data_tool, remove_user_tool, more_tools_tool]
 tool_node = ToolNode(tools)
 
 
+# --------------------------------------------------------- TOOL SELECTION
+# Tools bound to the model in each conversation phase. Only the schemas of the tools relevant to the current phase
+# are sent with the request, the tool node still knows every tool. MoreTools is bound while some tools are not, so the
+# model can get every tool when the keywords missed the phase of the request.
+PHASE_TOOLS = {
+    "inquiry": (service_data_tool, check_datetime_availability_tool, more_tools_tool),
+    "booking": (service_data_tool, check_datetime_availability_tool, schedule_appointment_tool,
+                check_user_appointment_data_tool, more_tools_tool),
+    "account": (service_data_tool, check_datetime_availability_tool, check_user_appointment_data_tool,
+                update_user_data_tool, cancel_appointment_tool, remove_user_tool, more_tools_tool),
+}
+# keywords in user's messages which signal the conversation phase (inquiry is the default phase)
+PHASE_KEYWORDS = {
+    "booking": ("book", "schedul", "appointment", "reserv", "availab", "free", "slot", "repair", "fix"),
+    "account": ("update", "change", "modify", "edit", "correct", "reschedul", "postpone", "move", "cancel", "delet",
+                "remov", "erase", "my data", "my detail", "my info", "my account", "my name", "my email",
+                "my e-mail", "my phone", "my number", "my car", "my vehicle", "my plate", "my appointment"),
+}
+DEFAULT_PHASE = "inquiry"
+# the phases a call of the tool signals (tools bound in every phase, ServiceData and CheckDatetimeAvailabilityTool,
+# signal no phase)
+TOOL_PHASES = {
+    schedule_appointment_tool.name: ("booking",),
+    check_user_appointment_data_tool.name: ("account",),
+    update_user_data_tool.name: ("account",),
+    cancel_appointment_tool.name: ("account",),
+    remove_user_tool.name: ("account",),
+    more_tools_tool.name: ("booking", "account"),
+}
+
+tools_by_name = {t.name: t for t in tools}
+
+
+@lru_cache(maxsize=None)
+def estimate_tool_schema_tokens(tool_name: str) -> int:
+    """Estimate the number of prompt tokens a bound tool schema takes (counted on the first model call)."""
+    return token_estimator.count_text(json.dumps(convert_to_openai_tool(tools_by_name[tool_name])))
+
+
+def _phases_from_text(text: str) -> set:
+    text = text.lower()
+    return {phase for phase, keywords in PHASE_KEYWORDS.items() if any(k in text for k in keywords)}
+
+
+def _message_phases(message) -> set:
+    """Phases signalled by the tool calls of an AI message or the text of a user's message."""
+    if isinstance(message, AIMessage) and message.tool_calls:
+        return {phase for call in message.tool_calls for phase in TOOL_PHASES.get(call["name"], ())}
+    if isinstance(message, HumanMessage) and isinstance(message.content, str):
+        return _phases_from_text(message.content)
+    return set()
+
+
+def select_phases(messages: list) -> tuple:
+    """
+    Determine the conversation phases from the most recent messages. Tool calls and user's messages are scanned from
+    the newest to the oldest until one of them signals a phase, so short answers ("yes", "tomorrow") keep the phase.
+    A started booking keeps its tools (e.g. while the user gives their contact details) until the appointment is
+    scheduled.
+    """
+    phases = set()
+    position = len(messages)
+    while position > 0 and not phases:
+        position -= 1
+        phases = _message_phases(messages[position])
+
+    if "booking" not in phases:
+        for message in reversed(messages[:position]):
+            if isinstance(message, AIMessage) and any(call["name"] == schedule_appointment_tool.name
+                                                      for call in message.tool_calls):
+                break
+            if "booking" in _message_phases(message):
+                phases.add("booking")
+                break
+    return tuple(sorted(phases)) or (DEFAULT_PHASE,)
+
+
+def select_tools(phases: tuple) -> tuple:
+    """
+    Get names of the tools for the given phases, ordered as in the list of all tools (without MoreTools if every
+    other tool is selected).
+    """
+    selected = {t.name for phase in phases for t in PHASE_TOOLS[phase]}
+    if len(selected) == len(tools):
+        selected.discard(more_tools_tool.name)
+    return tuple(t.name for t in tools if t.name in selected)
+
+
+# bound models per event loop: the connections of a model's HTTP client can only be used in the loop which opened them
+_loop_llms = {}
+
+
+def get_bound_llms(tool_names: tuple) -> tuple:
+    """
+    Create the chain of models (the primary model and the fallbacks) as (model name, model) pairs with the given tools
+    bound, cached per tool subset. The app runs every turn in a new event loop, so the models and their HTTP client are
+    created per running event loop (the cached models of the closed loops are dropped).
+    """
+    loop = asyncio.get_running_loop()
+    for closed_loop in [l for l in _loop_llms if l.is_closed()]:
+        del _loop_llms[closed_loop]
+    http_client, bound_llms = _loop_llms.setdefault(loop, (DefaultAsyncHttpxClient(), {}))
+    if tool_names not in bound_llms:
+        bound_tools = [tools_by_name[name] for name in tool_names]
+        bound_llms[tool_names] = tuple((model_name, ChatOpenAI(
+            model=model_name,
+            temperature=TEMPERATURE,
+            streaming=True,
+            stream_usage=True,
+            http_async_client=http_client
+        ).bind_tools(bound_tools, parallel_tool_calls=False)) for model_name in (MODEL_NAME, *FALLBACK_MODEL_NAMES))
+    return bound_llms[tool_names]
+
+
+# deadlines, hedging and fallbacks of the model calls
+model_invoker = ModelInvoker()
+
+
 # --------------------------------------------------------- GRAPH
 class State(TypedDict):
     messages: Annotated[list, add_messages]
     user_id: str
+    prefetched: dict  # prefetched tool results: prefetch key -> {"content": ..., "fetched_at": ...}
 
 
 graph = StateGraph(State)
@@ -560,23 +657,91 @@ def should_continue(state: State) -> Literal["tools", "__end__"]:
     return "__end__"
 
 
+# Speculative prefetch: reads the model often asks for first are run concurrently with the first model call, their results are served from
+# the State if the model calls the tool with the same arguments (the arguments the result depends on) within the TTL.
+PREFETCH_TTL_S = 60
+PREFETCH_KEY_ARGS = {
+    check_user_appointment_data_tool.name: (),  # the result depends only on the user_id
+    check_datetime_availability_tool.name: ("date", "time"),
+}
+# tools which change data, prefetched results are discarded after they run
+WRITE_TOOL_NAMES = {schedule_appointment_tool.name, update_user_data_tool.name, cancel_appointment_tool.name,
+                    remove_user_tool.name}
+# date and time mentioned in the user's message, e.g. 2025-01-31 10:30 or 2025-01-31 at 10:30
+PREFETCH_DATETIME_RE = re.compile(r"(\d{4}-\d{2}-\d{2})(?:T|\s+at\s+|\s+)(\d{1,2}:\d{2})")
+MAX_PREFETCHED_DATETIMES = 3
+
+
+def prefetch_key(tool_name: str, args: dict) -> str | None:
+    """Key of the tool call's result in the prefetched results (None if the tool is not prefetched)."""
+    if (key_args := PREFETCH_KEY_ARGS.get(tool_name)) is None:
+        return None
+    return json.dumps([tool_name, *(str(args.get(arg, "")).strip().zfill(5) if arg == "time"
+                                   else str(args.get(arg, "")).strip() for arg in key_args)])
+
+
+def _prefetch(state: State):
+    """Run the likely tool reads while the model is thinking."""
+    calls = [(check_user_appointment_data_tool, {"user_id": state["user_id"], "phone_number": ""})]
+    last_message = state["messages"][-1]
+    if isinstance(last_message, HumanMessage) and isinstance(last_message.content, str):
+        for date, time_ in PREFETCH_DATETIME_RE.findall(last_message.content)[:MAX_PREFETCHED_DATETIMES]:
+            calls.append((check_datetime_availability_tool, {"date": date, "time": time_.zfill(5)}))
+
+    fetched_at = time.time()
+    prefetched = {}
+    for tool, args in calls:
+        try:
+            prefetched[prefetch_key(tool.name, args)] = {"content": tool._run(**args), "fetched_at": fetched_at}
+        except Exception as e:
+            print(e)
+    return {"prefetched": prefetched}
+
+
+async def _call_tools(state: State, config: RunnableConfig):
+    """Serve the tool calls from the prefetched results if possible, otherwise run the tools."""
+    tool_calls = state["messages"][-1].tool_calls
+    prefetched = state.get("prefetched") or {}
+    now = time.time()
+    entries = [prefetched.get(prefetch_key(call["name"], call["args"])) for call in tool_calls]
+    if all(entry is not None and now - entry["fetched_at"] <= PREFETCH_TTL_S for entry in entries):
+        return {"messages": [ToolMessage(content=entry["content"], name=call["name"], tool_call_id=call["id"])
+                             for call, entry in zip(tool_calls, entries)]}
+
+    result = await tool_node.ainvoke(state, config)
+    if any(call["name"] in WRITE_TOOL_NAMES for call in tool_calls):
+        result["prefetched"] = {}
+    return result
+
+
 # Invocation of the model
-def _call_model(state: State):
+async def _call_model(state: State, config: RunnableConfig):
     messages = state["messages"]
-    llm = ChatOpenAI(
-        model=MODEL_NAME,
-        temperature=TEMPERATURE,
-        streaming=True,
-        stream_usage=True
-    ).bind_tools(tools, parallel_tool_calls=False)
-    response = llm.invoke(messages)
+    phases = select_phases(messages)
+    tool_names = select_tools(phases)
+    llms = get_bound_llms(tool_names)
+
+    # reject the call up front if the conversation would not fit into the token limit
+    tool_schema_tokens = sum(estimate_tool_schema_tokens(name) for name in tool_names)
+    check_token_budget(messages, extra_tokens=tool_schema_tokens)
+
+    response, _ = await model_invoker.ainvoke(llms, messages, config)
+    # the selected tools and the prompt tokens (estimated from the tool schemas) saved by binding only them
+    response.response_metadata["tool_selection"] = {
+        "phases": list(phases),
+        "tools": list(tool_names),
+        "saved_prompt_tokens": sum(estimate_tool_schema_tokens(t.name) for t in tools) - tool_schema_tokens,
+    }
     return {"messages": [response]}
 
 
-# Structure of the graph
+# Structure of the graph (the prefetch runs in parallel with the first model call)
 graph.add_edge(START, "modelNode")
-graph.add_node("tools", tool_node)
+graph.add_edge(START, "prefetchNode")
+graph.add_node("tools", _call_tools)
 graph.add_node("modelNode", _call_model)
+graph.add_node("prefetchNode", _prefetch)
+graph.add_edge("prefetchNode", END)
 
 # Add conditional logic to determine the next step based on the state (to continue or to end)
 graph.add_conditional_edges(
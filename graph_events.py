@@ -0,0 +1,101 @@
+"""
+Lightweight event stream of the graph for the UI.
+
+Instead of astream_events (an event for the start, the stream and the end of every runnable in the graph) only the
+events the UI shows are produced: the text chunks of the model node (collected by a callback handler which ignores the
+other runnables), the complete model responses with their token usage and the tool calls with their results (from the
+"updates" stream mode, one update per node). Each event is a small GraphEvent tuple.
+"""
+import asyncio
+from typing import Any, AsyncIterator, NamedTuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage, ToolMessage
+
+MODEL_NODE = "modelNode"
+TOOLS_NODE = "tools"
+
+TOKEN = "token"  # text: the chunk of the model's response
+MESSAGE = "message"  # data: the complete AIMessage of a model call (possibly served by a hedged or fallback request)
+USAGE = "usage"  # data: total tokens of the model call
+TOOL_START = "tool_start"  # name, call_id, data: arguments of the tool call
+TOOL_END = "tool_end"  # name, call_id, text: output of the tool
+
+
+class GraphEvent(NamedTuple):
+    kind: str
+    text: str = ""
+    name: str = ""
+    call_id: str = ""
+    data: Any = None
+
+
+_DONE = GraphEvent("done")
+
+
+class _ModelTokenHandler(BaseCallbackHandler):
+    """Puts the tokens of the chat models run by the model node to the queue (in the event loop, without a thread)."""
+    run_inline = True
+    ignore_chain = True
+    ignore_agent = True
+    ignore_retriever = True
+    ignore_custom_event = True
+
+    def __init__(self, queue: asyncio.Queue) -> None:
+        self.queue = queue
+        self.model_runs = set()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs) -> None:
+        if metadata and metadata.get("langgraph_node") == MODEL_NODE:
+            self.model_runs.add(run_id)
+
+    def on_llm_new_token(self, token: str, *, run_id, **kwargs) -> None:
+        if token and run_id in self.model_runs:
+            self.queue.put_nowait(GraphEvent(TOKEN, token))
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        self.model_runs.discard(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        self.model_runs.discard(run_id)
+
+
+def _update_events(update: dict):
+    """GraphEvents of one update of the "updates" stream mode ({node name: output of the node})."""
+    for node, output in update.items():
+        if node == MODEL_NODE:
+            for message in output["messages"]:
+                if isinstance(message, AIMessage):
+                    yield GraphEvent(MESSAGE, data=message)
+                    if message.usage_metadata:
+                        yield GraphEvent(USAGE, data=message.usage_metadata["total_tokens"])
+                    for call in message.tool_calls:
+                        yield GraphEvent(TOOL_START, name=call["name"], call_id=call["id"], data=call["args"])
+        elif node == TOOLS_NODE:
+            for message in output.get("messages", ()):
+                if isinstance(message, ToolMessage):
+                    yield GraphEvent(TOOL_END, text=str(message.content), name=message.name or "",
+                                     call_id=message.tool_call_id)
+
+
+async def stream_graph_events(runnable, inputs: dict, config: dict | None = None) -> AsyncIterator[GraphEvent]:
+    """Run the graph and yield the GraphEvents of the model and tools nodes in the order they happen."""
+    queue = asyncio.Queue()
+    config = dict(config or {})
+    config["callbacks"] = [*(config.get("callbacks") or []), _ModelTokenHandler(queue)]
+
+    async def run_graph():
+        try:
+            async for update in runnable.astream(inputs, config, stream_mode="updates"):
+                for event in _update_events(update):
+                    queue.put_nowait(event)
+        finally:
+            queue.put_nowait(_DONE)
+
+    task = asyncio.ensure_future(run_graph())
+    try:
+        while (event := await queue.get()) is not _DONE:
+            yield event
+        await task  # raise the exception of the graph, if any
+    finally:
+        task.cancel()
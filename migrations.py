@@ -0,0 +1,280 @@
+"""
+Versioned schema migrations of the service database.
+
+The schema version is stored in PRAGMA user_version. Every migration step has a version, a schema change run in one
+transaction and an optional backfill of existing rows. Backfills run in chunks of rows, each chunk in its own short
+transaction, so the database is never locked for the whole backfill. The version is bumped only after the step is
+completed, an interrupted step is simply run again (steps are idempotent).
+"""
+import sqlite3
+from contextlib import contextmanager
+
+from utility_func import ActivityStatus
+
+# rows updated in one transaction of a backfill
+BACKFILL_CHUNK_SIZE = 50_000
+
+
+@contextmanager
+def transaction(conn: sqlite3.Connection):
+    """Run the statements in one explicit transaction (DDL statements included)."""
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None  # manage the transaction manually
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    else:
+        conn.execute("COMMIT")
+    finally:
+        conn.isolation_level = isolation_level
+
+
+def get_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def get_columns(conn: sqlite3.Connection, table: str) -> set:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def backfill_in_chunks(conn: sqlite3.Connection, table: str, set_clause: str, where: str,
+                       chunk_size: int = BACKFILL_CHUNK_SIZE) -> int:
+    """Update rows matching the where clause by ranges of rowids. Returns the number of updated rows."""
+    max_rowid = conn.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0] or 0
+    updated = 0
+    for start in range(0, max_rowid, chunk_size):
+        with transaction(conn):
+            cursor = conn.execute(f"UPDATE {table} SET {set_clause} WHERE rowid > ? AND rowid <= ? AND ({where})",
+                                  (start, start + chunk_size))
+            updated += cursor.rowcount
+    return updated
+
+
+# --------------------------------------------------------- VERSION 1
+def _v1_initial_schema(conn: sqlite3.Connection) -> None:
+    """Users, cars and appointments tables."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id TEXT NOT NULL PRIMARY KEY,
+        "name" TEXT NOT NULL,
+        surname TEXT NOT NULL,
+        email VARCHAR(320) NOT NULL UNIQUE,
+        phone_number VARCHAR(15) NOT NULL UNIQUE,
+        status VARCHAR(7) NOT NULL,
+        date_registered VARCHAR(19) NOT NULL,
+        date_updated VARCHAR(19),
+        date_deleted VARCHAR(19)
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS cars (
+        id TEXT NOT NULL PRIMARY KEY,
+        license_plate VARCHAR(12) NOT NULL UNIQUE,
+        manufacturer TEXT NOT NULL,
+        model TEXT NOT NULL,
+        "year" INTEGER NOT NULL,
+        status VARCHAR(7) NOT NULL,
+        user_id TEXT NOT NULL,
+        user_status VARCHAR(7) NOT NULL,
+        date_registered VARCHAR(19) NOT NULL,
+        date_updated VARCHAR(19),
+        date_deleted VARCHAR(19),
+        FOREIGN KEY(user_id) REFERENCES users(id),
+        FOREIGN KEY(user_status) REFERENCES users(status)
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS appointments (
+        id TEXT NOT NULL PRIMARY KEY,
+        "datetime" VARCHAR(17) NOT NULL,
+        problem TEXT NOT NULL,
+        status VARCHAR(10) NOT NULL,
+        user_id TEXT NOT NULL,
+        user_status VARCHAR(7) NOT NULL,
+        car_id TEXT NOT NULL,
+        car_status VARCHAR(7) NOT Null,
+        date_scheduled VARCHAR(19) NOT NULL,
+        date_canceled VARCHAR(19),
+        date_updated VARCHAR(19),
+        date_deleted VARCHAR(19),
+        FOREIGN KEY(user_id) REFERENCES users(id),
+        FOREIGN KEY(user_status) REFERENCES users(status),
+        FOREIGN KEY(car_id) REFERENCES cars(id),
+        FOREIGN KEY(car_status) REFERENCES cars(status)
+    )
+    """)
+
+
+# --------------------------------------------------------- VERSION 2
+# typed appointment dates: unix epoch seconds and days since the unix epoch (datetimes are stored without timezone)
+_DATETIME_EPOCH = "CAST(strftime('%s', TRIM({column})) AS INTEGER)"
+_TYPED_APPOINTMENT_DATES = {
+    "datetime_epoch": _DATETIME_EPOCH.format(column="datetime"),
+    "day_ordinal": _DATETIME_EPOCH.format(column="datetime") + " / 86400",
+    "date_scheduled_epoch": _DATETIME_EPOCH.format(column="date_scheduled"),
+}
+
+
+def _v2_typed_appointment_dates(conn: sqlite3.Connection) -> None:
+    """Integer date columns of appointments, kept in sync with the text columns by triggers."""
+    existing_columns = get_columns(conn, "appointments")
+    for column in _TYPED_APPOINTMENT_DATES:
+        if column not in existing_columns:
+            conn.execute(f"ALTER TABLE appointments ADD COLUMN {column} INTEGER")
+
+    set_clause = ", ".join(f"{column} = {expression}" for column, expression in _TYPED_APPOINTMENT_DATES.items())
+    # rows inserted with the typed columns already set are left as they are
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS appointments_typed_dates_insert AFTER INSERT ON appointments
+    WHEN NEW.day_ordinal IS NULL
+    BEGIN
+        UPDATE appointments SET {set_clause} WHERE rowid = NEW.rowid;
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS appointments_typed_dates_update AFTER UPDATE OF "datetime", date_scheduled
+    ON appointments
+    BEGIN
+        UPDATE appointments SET {set_clause} WHERE rowid = NEW.rowid;
+    END
+    """)
+
+
+def _v2_backfill(conn: sqlite3.Connection, chunk_size: int) -> None:
+    set_clause = ", ".join(f"{column} = {expression}" for column, expression in _TYPED_APPOINTMENT_DATES.items())
+    backfill_in_chunks(conn, "appointments", set_clause, "day_ordinal IS NULL", chunk_size)
+    # the index is built once the rows are filled in
+    with transaction(conn):
+        conn.execute("CREATE INDEX IF NOT EXISTS appointments_user_day ON appointments (user_id, day_ordinal)")
+
+
+# --------------------------------------------------------- VERSION 3
+def _v3_slow_query_log(conn: sqlite3.Connection) -> None:
+    """Log of the slow statements run by the tools (see db_profiler)."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS slow_query_log (
+        id INTEGER PRIMARY KEY,
+        tool TEXT NOT NULL,
+        "statement" TEXT NOT NULL,
+        latency_ms REAL NOT NULL,
+        rows_returned INTEGER NOT NULL,
+        rows_affected INTEGER NOT NULL,
+        vm_steps INTEGER NOT NULL,
+        query_plan TEXT,
+        date_logged VARCHAR(19) NOT NULL
+    )
+    """)
+
+
+# --------------------------------------------------------- VERSION 4
+_DELETED = ActivityStatus.DELETED.value
+
+
+def _cascade_set_clause(status_column: str, new_status: str, bump_version: bool = False) -> str:
+    """
+    Set the denormalized status column, delete the row (once) if the referenced row was deleted (and bump the row
+    version, see version 5).
+    """
+    return f"""{status_column} = {new_status},
+        date_deleted = CASE WHEN {new_status} = '{_DELETED}' AND status != '{_DELETED}' THEN {{date_deleted}}
+         ELSE date_deleted END,
+        status = CASE WHEN {new_status} = '{_DELETED}' THEN '{_DELETED}' ELSE status END""" + (
+        ",\n        version = version + 1" if bump_version else "")
+
+
+def _create_status_cascade_triggers(conn: sqlite3.Connection, bump_version: bool) -> None:
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS users_status_cascade AFTER UPDATE OF status ON users
+    WHEN NEW.status IS NOT OLD.status
+    BEGIN
+        UPDATE cars
+        SET {_cascade_set_clause("user_status", "NEW.status", bump_version).format(date_deleted="NEW.date_deleted")}
+        WHERE user_id = NEW.id;
+        UPDATE appointments
+        SET {_cascade_set_clause("user_status", "NEW.status", bump_version).format(date_deleted="NEW.date_deleted")}
+        WHERE user_id = NEW.id;
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS cars_status_cascade AFTER UPDATE OF status ON cars
+    WHEN NEW.status IS NOT OLD.status
+    BEGIN
+        UPDATE appointments
+        SET {_cascade_set_clause("car_status", "NEW.status", bump_version).format(date_deleted="NEW.date_deleted")}
+        WHERE car_id = NEW.id;
+    END
+    """)
+
+
+def _v4_status_cascade(conn: sqlite3.Connection) -> None:
+    """Indexes on the references and triggers cascading status changes of users and cars."""
+    conn.execute("CREATE INDEX IF NOT EXISTS cars_user ON cars (user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS appointments_car ON appointments (car_id)")
+    # appointments of a user are found by the appointments_user_day index
+    _create_status_cascade_triggers(conn, bump_version=False)
+
+
+def _v4_backfill(conn: sqlite3.Connection, chunk_size: int) -> None:
+    """Refresh the denormalized statuses (and delete rows of deleted users and cars) written before the triggers."""
+    user_status = "COALESCE((SELECT users.status FROM users WHERE users.id = {table}.user_id), user_status)"
+    car_status = "COALESCE((SELECT cars.status FROM cars WHERE cars.id = appointments.car_id), car_status)"
+    date_deleted = "COALESCE(date_deleted, (SELECT users.date_deleted FROM users WHERE users.id = {table}.user_id))"
+
+    cars_user_status = user_status.format(table="cars")
+    backfill_in_chunks(conn, "cars", _cascade_set_clause("user_status", cars_user_status).format(
+        date_deleted=date_deleted.format(table="cars")), f"user_status IS NOT {cars_user_status}", chunk_size)
+
+    appointments_user_status = user_status.format(table="appointments")
+    appointments_date_deleted = date_deleted.format(table="appointments")
+    backfill_in_chunks(conn, "appointments", _cascade_set_clause("user_status", appointments_user_status).format(
+        date_deleted=appointments_date_deleted), f"user_status IS NOT {appointments_user_status}", chunk_size)
+    backfill_in_chunks(conn, "appointments", _cascade_set_clause("car_status", car_status).format(
+        date_deleted=appointments_date_deleted), f"car_status IS NOT {car_status}", chunk_size)
+
+
+# --------------------------------------------------------- VERSION 5
+_VERSIONED_TABLES = ("users", "cars", "appointments")
+
+
+def _v5_row_versions(conn: sqlite3.Connection) -> None:
+    """
+    Row version counters for optimistic concurrency (date_updated has a resolution of one second), bumped by every
+    update of the row including the status cascades.
+    """
+    for table in _VERSIONED_TABLES:
+        if "version" not in get_columns(conn, table):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    conn.execute("DROP TRIGGER IF EXISTS users_status_cascade")
+    conn.execute("DROP TRIGGER IF EXISTS cars_status_cascade")
+    _create_status_cascade_triggers(conn, bump_version=True)
+
+
+# (version, schema change, backfill or None)
+MIGRATIONS = [
+    (1, _v1_initial_schema, None),
+    (2, _v2_typed_appointment_dates, _v2_backfill),
+    (3, _v3_slow_query_log, None),
+    (4, _v4_status_cascade, _v4_backfill),
+    (5, _v5_row_versions, None),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(conn: sqlite3.Connection, target_version: int = LATEST_VERSION,
+            chunk_size: int = BACKFILL_CHUNK_SIZE) -> int:
+    """Upgrade the database schema to the target version. Returns the version of the database."""
+    version = get_version(conn)
+    for step_version, schema_step, backfill_step in MIGRATIONS:
+        if step_version <= version or step_version > target_version:
+            continue
+        with transaction(conn):
+            schema_step(conn)
+        if backfill_step is not None:
+            backfill_step(conn, chunk_size)
+        with transaction(conn):
+            conn.execute(f"PRAGMA user_version = {step_version}")
+        version = step_version
+    return version
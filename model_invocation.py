@@ -0,0 +1,174 @@
+"""
+Resilient invocation of the chat model.
+
+Every attempt has a deadline. If the primary model does not answer within the hedge delay (the p95 of the recent
+latencies), a duplicate request is sent, the first response wins and the other request is cancelled. If the primary
+model fails, the fallback models are tried in order. Only the first request of the primary model streams its tokens
+(uses the callbacks of the given config), the hedged and fallback requests run silently. Each response records which
+path served it in response_metadata["served_by"].
+"""
+import asyncio
+import random
+import re
+import statistics
+import time
+from collections import deque
+from typing import NamedTuple
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+ATTEMPT_TIMEOUT_S = 30.0
+# hedge delay used until there are enough latency samples
+HEDGE_DELAY_DEFAULT_S = 8.0
+HEDGE_MIN_SAMPLES = 20
+LATENCY_HISTORY_SIZE = 200
+
+
+class ModelInvocationException(Exception):
+    pass
+
+
+class InvocationRecord(NamedTuple):
+    model: str
+    path: str  # "primary", "hedge" or "fallback"
+    attempt: int  # index of the model in the chain
+    latency_s: float
+    errors: tuple
+
+
+class ModelInvoker:
+    """Invokes a chain of models (primary first, then fallbacks) and keeps latency statistics of the primary model."""
+
+    def __init__(self, attempt_timeout_s: float = ATTEMPT_TIMEOUT_S, hedge: bool = True,
+                 hedge_delay_default_s: float = HEDGE_DELAY_DEFAULT_S, hedge_min_samples: int = HEDGE_MIN_SAMPLES,
+                 history_size: int = LATENCY_HISTORY_SIZE) -> None:
+        self.attempt_timeout_s = attempt_timeout_s
+        self.hedge = hedge
+        self.hedge_delay_default_s = hedge_delay_default_s
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = deque(maxlen=history_size)
+        self.records = deque(maxlen=history_size)
+
+    def hedge_delay(self) -> float:
+        """The p95 latency of the recent responses (or the default delay while there are too few samples)."""
+        if len(self.latencies) < self.hedge_min_samples:
+            return min(self.hedge_delay_default_s, self.attempt_timeout_s)
+        return min(statistics.quantiles(self.latencies, n=20)[-1], self.attempt_timeout_s)
+
+    async def _attempt(self, model, messages: list, config: dict):
+        return await asyncio.wait_for(model.ainvoke(messages, config), self.attempt_timeout_s)
+
+    async def _invoke_hedged(self, model, messages: list, config: dict, silent_config: dict, errors: list) -> tuple:
+        """Invoke the model, send a duplicate request after the hedge delay. Returns the response and its path."""
+        start = time.perf_counter()
+        tasks = {asyncio.ensure_future(self._attempt(model, messages, config)): "primary"}
+        try:
+            if self.hedge:
+                done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay())
+                if not done:
+                    tasks[asyncio.ensure_future(self._attempt(model, messages, silent_config))] = "hedge"
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.latencies.append(time.perf_counter() - start)
+                        return task.result(), tasks[task]
+                    errors.append(f"{tasks[task]}: {task.exception()!r}")
+            raise ModelInvocationException("All requests to the primary model failed.")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def ainvoke(self, models: list, messages: list, config: dict | None = None) -> tuple:
+        """
+        Invoke the chain of (model name, model) pairs with the messages. Returns the response and its
+        InvocationRecord, raises ModelInvocationException if all models failed.
+        """
+        config = config or {}
+        silent_config = {**config, "callbacks": []}
+        errors = []
+        start = time.perf_counter()
+        for attempt, (name, model) in enumerate(models):
+            try:
+                if attempt == 0:
+                    response, path = await self._invoke_hedged(model, messages, config, silent_config, errors)
+                else:
+                    response, path = await self._attempt(model, messages, silent_config), "fallback"
+            except Exception as e:
+                errors.append(f"{name}: {e!r}")
+                continue
+            record = InvocationRecord(model=name, path=path, attempt=attempt, latency_s=time.perf_counter() - start,
+                                      errors=tuple(errors))
+            self.records.append(record)
+            response.response_metadata["served_by"] = record._asdict()
+            return response, record
+        raise ModelInvocationException(f"All models failed: {'; '.join(errors)}")
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Local stand-in for a chat model which injects latency and errors, for tests and benchmarks. The first word of the
+    response is streamed right away, the rest after the latency of the call (latencies_s of the first calls, then
+    latency_s plus a random jitter), so a stalled stream can be hedged.
+    """
+    response: str = "How can I help you?"
+    latency_s: float = 0.0
+    latency_jitter_s: float = 0.0
+    latencies_s: tuple = ()
+    error_rate: float = 0.0
+    seed: int = 0
+    calls: int = 0
+    _rng: random.Random = PrivateAttr(default=None)
+
+    def model_post_init(self, context) -> None:
+        self._rng = random.Random(self.seed)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _next_call(self) -> tuple:
+        """Pieces of the response, the piece before which the call stalls, the latency and whether the call fails."""
+        call = self.calls
+        self.calls += 1
+        latency_s = (self.latencies_s[call] if call < len(self.latencies_s)
+                     else self.latency_s + self._rng.uniform(0, self.latency_jitter_s))
+        fails = self._rng.random() < self.error_rate
+        pieces = re.findall(r"\s*\S+", self.response) or [""]
+        return pieces, 1 if len(pieces) > 1 else 0, latency_s, fails
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        pieces, stall_at, latency_s, fails = self._next_call()
+        for number, piece in enumerate(pieces):
+            if number == stall_at:
+                time.sleep(latency_s)
+                if fails:
+                    raise RuntimeError("Injected model error.")
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager is not None:
+                run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        pieces, stall_at, latency_s, fails = self._next_call()
+        for number, piece in enumerate(pieces):
+            if number == stall_at:
+                await asyncio.sleep(latency_s)
+                if fails:
+                    raise RuntimeError("Injected model error.")
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        text = "".join(chunk.message.content for chunk in self._stream(messages, stop, run_manager))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        text = "".join([chunk.message.content async for chunk in self._astream(messages, stop, run_manager)])
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
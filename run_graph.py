@@ -1,17 +1,24 @@
-from langchain_core.messages import AIMessage
+import time
+from contextlib import aclosing
+
 import streamlit as st
 from graph import graph_runnable, MAX_TOKENS
+from graph_events import stream_graph_events, TOKEN, MESSAGE, USAGE, TOOL_START, TOOL_END
+from model_invocation import ModelInvocationException
+from transcript_store import transcript_store
 from utility_func import TokenExceededException
 
 
-async def invoke_graph(st_messages, st_placeholder, st_user_id):
+async def invoke_graph(st_messages, st_placeholder, st_user_id, st_session_id):
     """
     Asynchronously processes a stream of events from the graph_runnable and updates the Streamlit interface.
+    Only the events of the model and the tools are streamed (see graph_events).
 
     Args:
         st_messages (list): List of messages to be sent to the graph_runnable.
         st_placeholder (st.beta_container): Streamlit placeholder used to display updates and statuses.
         st_user_id (string): User ID to pass to the graph_runnable
+        st_session_id (string): Session ID the turn is recorded under in the transcript store
 
     Returns:
         AIMessage: An AIMessage object containing the final aggregated text content from the events.
@@ -21,57 +28,89 @@ async def invoke_graph(st_messages, st_placeholder, st_user_id):
     thoughts_placeholder = container.container()  # Container for displaying status messages
     token_placeholder = container.empty()  # Placeholder for displaying progressive token updates
     final_text = ""  # Will store the accumulated text from the model's response
+    model_call_start = 0  # Position in final_text where the text of the current model call begins
     total_tokens_used = 0
+    saved_prompt_tokens = 0  # prompt tokens saved by the tool selection over the model calls of the turn
+
+    output_placeholders = {}  # tool call id -> placeholder for the tool's output
 
-    # Stream events from the graph_runnable asynchronously
-    # config = {"configurable": {"user_id": st_user_id}}
-    async for event in graph_runnable.astream_events({"messages": st_messages, "user_id": st_user_id}, version="v2"):
+    # Record the turn in the transcript (the records are only queued, they are written by a background thread)
+    turn_start = time.perf_counter()
+    error = None
+    transcript_store.append_message(st_session_id, st_messages[-1], user_id=st_user_id)
 
-        # Get token count from events
-        if "output" in event['data'] and "messages" in event['data']['output']:
-            last_message = event["data"]["output"]["messages"][-1]
-            if isinstance(last_message, AIMessage):
-                total_tokens_used = max(total_tokens_used, last_message.usage_metadata["total_tokens"])
-        elif "input" in event['data'] and event["data"]["input"] and "messages" in event["data"]["input"]:
-            last_message = event["data"]["input"]["messages"][-1]
-            if isinstance(last_message, AIMessage):
-                total_tokens_used = max(total_tokens_used, last_message.usage_metadata["total_tokens"])
+    # Stream the events of the model and the tools from the graph_runnable asynchronously
+    try:
+        events = stream_graph_events(graph_runnable, {"messages": st_messages, "user_id": st_user_id})
+        async with aclosing(events):  # stop the graph when the loop is left early
+            async for event in events:
+                kind = event.kind  # Determine the type of event received
 
-        # Stop the execution once the user exceeded the token limit
-        if total_tokens_used > MAX_TOKENS:
-            # final_text is passed as an argument to save AI's response in st.session_state.messages
-            raise TokenExceededException("Token limit exceeded. Restart the conversation.", final_text)
+                if kind == TOKEN:
+                    # A new chunk of the model's response
+                    final_text += event.text
+                    token_placeholder.write(final_text)  # Update the st placeholder with the progressive response
 
-        # Handle events
-        kind = event["event"]  # Determine the type of event received
+                elif kind == MESSAGE:
+                    # End of a model call, the text of the next call begins here
+                    response = event.data
+                    served_by = response.response_metadata.get("served_by", {})
+                    tool_selection = response.response_metadata.get("tool_selection", {})
+                    saved_prompt_tokens += tool_selection.get("saved_prompt_tokens", 0)
+                    transcript_store.append_message(st_session_id, response, user_id=st_user_id)
+                    transcript_store.append(st_session_id, "usage", user_id=st_user_id, model=served_by.get("model"),
+                                            path=served_by.get("path"), tools=tool_selection.get("tools"),
+                                            saved_prompt_tokens=tool_selection.get("saved_prompt_tokens"),
+                                            **(response.usage_metadata or {}))
+                    if served_by.get("path", "primary") != "primary":
+                        # A hedged or fallback request answered silently, replace the text streamed by the primary
+                        final_text = final_text[:model_call_start] + response.content
+                        token_placeholder.write(final_text)
+                    model_call_start = len(final_text)
 
-        if kind == "on_chat_model_stream":
-            # The event corresponding to a stream of new content (tokens or chunks of text)
-            addition = event["data"]["chunk"].content  # Extract the new content chunk
-            final_text += addition  # Append the new content to the accumulated text
-            if addition:
-                token_placeholder.write(final_text)  # Update the st placeholder with the progressive response
+                elif kind == USAGE:
+                    total_tokens_used = max(total_tokens_used, event.data)
+                    # Stop the execution once the user exceeded the token limit
+                    if total_tokens_used > MAX_TOKENS:
+                        # final_text is passed as an argument to save AI's response in st.session_state.messages
+                        raise TokenExceededException("Token limit exceeded. Restart the conversation.", final_text)
 
-        elif kind == "on_tool_start":
-            # The event signals that a tool is about to be called
-            with thoughts_placeholder:
-                status_placeholder = st.empty()  # Placeholder to show the tool's status
-                with status_placeholder.status("Calling Tool...", expanded=True) as s:
-                    st.write("Called ", event['name'])  # Show which tool is being called
-                    st.write("Tool input: ")
-                    st.code(event['data'].get('input'))  # Display the input data sent to the tool
-                    st.write("Tool output: ")
-                    output_placeholder = st.empty()  # Placeholder for tool output that will be updated later
-                    s.update(label="Completed Calling Tool!", expanded=False)  # Update the status once done
+                elif kind == TOOL_START:
+                    # The model called a tool
+                    transcript_store.append(st_session_id, "tool_call", user_id=st_user_id, name=event.name,
+                                            call_id=event.call_id, args=event.data)
+                    with thoughts_placeholder:
+                        status_placeholder = st.empty()  # Placeholder to show the tool's status
+                        with status_placeholder.status("Calling Tool...", expanded=True) as s:
+                            st.write("Called ", event.name)  # Show which tool is being called
+                            st.write("Tool input: ")
+                            st.code(event.data)  # Display the input data sent to the tool
+                            st.write("Tool output: ")
+                            # Placeholder for tool output that will be updated later
+                            output_placeholders[event.call_id] = st.empty()
+                            s.update(label="Completed Calling Tool!", expanded=False)  # Update the status once done
 
-        elif kind == "on_tool_end":
-            # The event signals the completion of a tool's execution
-            with thoughts_placeholder:
-                if 'output_placeholder' in locals():
-                    try:
-                        output_placeholder.code(event['data'].get('output').content)  # Display the tool's output
-                    except AttributeError:
-                        output_placeholder.code(event['data'].get('output'))
+                elif kind == TOOL_END:
+                    # The tool returned its output
+                    transcript_store.append(st_session_id, "tool_result", user_id=st_user_id, name=event.name,
+                                            call_id=event.call_id, content=event.text)
+                    if (output_placeholder := output_placeholders.pop(event.call_id, None)) is not None:
+                        output_placeholder.code(event.text)  # Display the tool's output
+    except TokenExceededException as e:
+        error = type(e).__name__
+        # the pre-flight check in the graph does not know the text streamed so far
+        raise TokenExceededException(e.args[0], final_text)
+    except ModelInvocationException as e:
+        error = type(e).__name__
+        # all models failed, final_text is what the primary model streamed before failing
+        raise ModelInvocationException(e.args[0], final_text)
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        transcript_store.append(st_session_id, "turn", user_id=st_user_id, error=error,
+                                latency_s=round(time.perf_counter() - turn_start, 3), total_tokens=total_tokens_used,
+                                saved_prompt_tokens=saved_prompt_tokens)
     print(total_tokens_used)
     # Return the final aggregated message after all events have been processed
     return final_text
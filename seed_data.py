@@ -0,0 +1,153 @@
+"""
+Synthetic data for the service database. Run with: python seed_data.py <db_file> --users N [options]
+
+The generator is seeded and the dates are relative to a fixed moment (--now), so the same arguments always produce the
+same data. Rows are written with bulk inserts in chunks, statuses are consistent across the tables (cars and
+appointments of deleted users are deleted, the denormalized user_status and car_status columns match the referenced
+rows).
+"""
+import argparse
+import json
+import random
+import sqlite3
+import uuid
+from datetime import datetime, timedelta
+from itertools import islice
+
+from migrations import migrate, get_columns
+from utility_func import ActivityStatus, DATETIME_FORMAT
+
+SEED_CHUNK_SIZE = 100_000
+# the dates are relative to this moment, so the same arguments produce the same data on any day
+SEED_NOW = datetime(2025, 1, 6, 12, 0, 0)
+
+# share of deleted users and cars
+DELETED_USERS_RATIO = 0.05
+DELETED_CARS_RATIO = 0.05
+# statuses of appointments of active users and cars (and their weights)
+APPOINTMENT_STATUS_WEIGHTS = {
+    ActivityStatus.SCHEDULED.value: 0.3,
+    ActivityStatus.COMPLETED.value: 0.5,
+    ActivityStatus.CANCELED.value: 0.2,
+}
+
+_MANUFACTURERS = {
+    "Toyota": ["Corolla", "Camry", "RAV4"],
+    "Ford": ["Focus", "Fiesta", "F-150"],
+    "Volkswagen": ["Golf", "Passat", "Polo"],
+    "Honda": ["Civic", "Accord", "CR-V"],
+}
+_PROBLEMS = ["Strange noise from the engine", "Brakes squeaking", "Oil change", "Check engine light is on",
+             "Flat tire", "Air conditioning does not work", "Regular service"]
+_NAMES = ["John", "Jane", "Alex", "Maria", "Peter", "Anna", "Mark", "Eva"]
+_SURNAMES = ["Smith", "Doe", "Brown", "Novak", "Miller", "Wilson", "Taylor", "Clark"]
+_UNIX_EPOCH = datetime(1970, 1, 1)
+
+
+def _uuid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def _working_slot(rng: random.Random, start: datetime, days: int) -> datetime:
+    """Random working day slot (9:00 - 17:30, every 30 minutes) within the days from start."""
+    slot = (start + timedelta(days=rng.randrange(days))).replace(hour=9, minute=0, second=0, microsecond=0)
+    while slot.weekday() in [5, 6]:
+        slot += timedelta(days=1)
+    return slot + timedelta(minutes=30 * rng.randrange(18))
+
+
+def _epoch(value: datetime) -> int:
+    return int((value - _UNIX_EPOCH).total_seconds())
+
+
+def generate_rows(users: int, cars_per_user: int, appointments_per_car: int, seed: int = 0,
+                  now: datetime = SEED_NOW):
+    """Generate ("users" | "cars" | "appointments", row) pairs, every user is followed by their cars and appointments."""
+    rng = random.Random(seed)
+    active, deleted = ActivityStatus.ACTIVE.value, ActivityStatus.DELETED.value
+    appointment_statuses = list(APPOINTMENT_STATUS_WEIGHTS)
+    appointment_weights = list(APPOINTMENT_STATUS_WEIGHTS.values())
+
+    for u in range(users):
+        user_id = _uuid(rng)
+        user_status = deleted if rng.random() < DELETED_USERS_RATIO else active
+        registered = now - timedelta(days=rng.randrange(1, 730))
+        date_deleted = now.strftime(DATETIME_FORMAT) if user_status == deleted else None
+        yield "users", (user_id, rng.choice(_NAMES), rng.choice(_SURNAMES), f"user{u}@example.com", f"+1{u:010d}",
+                        user_status, registered.strftime(DATETIME_FORMAT), None, date_deleted)
+
+        for c in range(cars_per_user):
+            car_id = _uuid(rng)
+            car_status = deleted if user_status == deleted or rng.random() < DELETED_CARS_RATIO else active
+            manufacturer = rng.choice(list(_MANUFACTURERS))
+            yield "cars", (car_id, f"P{u:08d}{c:03d}", manufacturer, rng.choice(_MANUFACTURERS[manufacturer]),
+                           rng.randrange(1995, now.year + 1), car_status, user_id, user_status,
+                           registered.strftime(DATETIME_FORMAT), None,
+                           now.strftime(DATETIME_FORMAT) if car_status == deleted else None)
+
+            for _ in range(appointments_per_car):
+                if car_status == deleted:
+                    status = deleted
+                else:
+                    status = rng.choices(appointment_statuses, appointment_weights)[0]
+                # scheduled appointments are in the next two months, the others in the past year
+                if status == ActivityStatus.SCHEDULED.value:
+                    appointment = _working_slot(rng, now + timedelta(days=1), 59)
+                else:
+                    appointment = _working_slot(rng, now - timedelta(days=365), 364)
+                scheduled = min(appointment, now) - timedelta(days=rng.randrange(1, 30))
+                yield "appointments", (
+                    _uuid(rng), appointment.strftime("%Y-%m-%dT%H:%M"), rng.choice(_PROBLEMS), status, user_id,
+                    user_status, car_id, car_status, scheduled.strftime(DATETIME_FORMAT),
+                    now.strftime(DATETIME_FORMAT) if status == ActivityStatus.CANCELED.value else None, None,
+                    now.strftime(DATETIME_FORMAT) if status == deleted else None,
+                    _epoch(appointment), _epoch(appointment) // 86400, _epoch(scheduled))
+
+
+_INSERTS = {
+    "users": """INSERT INTO users (id, "name", surname, email, phone_number, status, date_registered, date_updated,
+     date_deleted) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+    "cars": """INSERT INTO cars (id, license_plate, manufacturer, model, "year", status, user_id, user_status,
+     date_registered, date_updated, date_deleted) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+    "appointments": """INSERT INTO appointments (id, "datetime", problem, status, user_id, user_status, car_id,
+     car_status, date_scheduled, date_canceled, date_updated, date_deleted, datetime_epoch, day_ordinal,
+     date_scheduled_epoch) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+}
+
+
+def seed_database(db_file: str, users: int, cars_per_user: int = 1, appointments_per_car: int = 2, seed: int = 0,
+                  chunk_size: int = SEED_CHUNK_SIZE, now: datetime = SEED_NOW) -> dict:
+    """Fill the database (created or upgraded to the latest schema) with synthetic data. Returns the row counts."""
+    conn = sqlite3.connect(db_file)
+    migrate(conn)
+    if "day_ordinal" not in get_columns(conn, "appointments"):
+        raise RuntimeError("The appointments table has no typed date columns.")
+    # the seeded database is disposable, don't wait for the disk
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA journal_mode = MEMORY")
+
+    counts = dict.fromkeys(_INSERTS, 0)
+    rows = generate_rows(users, cars_per_user, appointments_per_car, seed, now)
+    while chunk := list(islice(rows, chunk_size)):
+        with conn:
+            for table, insert in _INSERTS.items():
+                table_rows = [row for row_table, row in chunk if row_table == table]
+                conn.executemany(insert, table_rows)
+                counts[table] += len(table_rows)
+    conn.execute("ANALYZE")
+    conn.close()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("db_file")
+    parser.add_argument("--users", type=int, required=True)
+    parser.add_argument("--cars-per-user", type=int, default=1)
+    parser.add_argument("--appointments-per-car", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--now", type=datetime.fromisoformat, default=SEED_NOW,
+                        help=f"Moment the dates are generated relative to (default: {SEED_NOW.isoformat()})")
+    args = parser.parse_args()
+    print(json.dumps(seed_database(args.db_file, args.users, args.cars_per_user, args.appointments_per_car,
+                                   args.seed, now=args.now)))
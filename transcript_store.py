@@ -0,0 +1,327 @@
+"""
+Persistent transcripts of the conversations. Replay with: python transcript_store.py <db_file> [options]
+
+Every message, tool call, tool result and token usage of a conversation is appended to the transcript store as a
+record with the session id. append() only puts the record into a bounded queue (records are dropped, never waited for,
+when the queue is full), a background thread writes the queued records in batches to gzip compressed JSON lines
+segments. Each batch is a separate gzip member, so a segment can be read while it is written. A new segment is started
+once the current one reaches SEGMENT_MAX_BYTES.
+
+The transcripts contain the users' personal data, so recording is opt-in (TRANSCRIPTS=1). The records of a turn carry
+the user id, the sessions of deleted users are purged from the segments (and their later records are not written).
+
+The replay feeds the recorded user messages of the sessions back through the graph_runnable (against a copy of the
+database) and compares the latency, the tool calls and the responses with the recorded ones.
+"""
+import argparse
+import asyncio
+import atexit
+import glob
+import gzip
+import json
+import os
+import queue
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime
+from typing import NamedTuple
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+
+TRANSCRIPT_DIR = os.environ.get("TRANSCRIPT_DIR", "transcripts")
+SEGMENT_MAX_BYTES = 16 * 1024 * 1024  # compressed size of a segment
+WRITE_BATCH_SIZE = 512
+FLUSH_INTERVAL_S = 1.0
+MAX_QUEUED_RECORDS = 100_000
+COMPRESS_LEVEL = 6
+
+_MESSAGE_ROLES = {SystemMessage: "system", HumanMessage: "human", AIMessage: "ai", ToolMessage: "tool"}
+
+
+class _Purge(NamedTuple):
+    """Queued request to purge the sessions of the users."""
+    user_ids: frozenset
+
+
+class TranscriptStore:
+    """Appends transcript records to the segments in the directory from a background writer thread."""
+
+    def __init__(self, directory: str = TRANSCRIPT_DIR, enabled: bool = True,
+                 segment_max_bytes: int = SEGMENT_MAX_BYTES, batch_size: int = WRITE_BATCH_SIZE,
+                 flush_interval_s: float = FLUSH_INTERVAL_S, max_queued_records: int = MAX_QUEUED_RECORDS) -> None:
+        self.directory = directory
+        self.enabled = enabled
+        self.segment_max_bytes = segment_max_bytes
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.dropped_records = 0
+        self.written_records = 0
+        self._queue = queue.Queue(maxsize=max_queued_records)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._segment_prefix = f"transcript-{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}"
+        self._segment_number = 0
+        self._purged_users = set()
+        self._purged_sessions = set()
+
+    # ----------------------------------------------------- recording (any thread, never blocks)
+    def append(self, session_id: str, record_type: str, **fields) -> bool:
+        """Queue the record for writing. Returns False if the record was dropped (store disabled or queue full)."""
+        if not self.enabled:
+            return False
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait({"session_id": session_id, "ts": time.time(), "type": record_type, **fields})
+        except queue.Full:
+            self.dropped_records += 1
+            return False
+        return True
+
+    def append_message(self, session_id: str, message, **fields) -> bool:
+        """Queue the LangChain message as a record (tool calls are recorded separately)."""
+        return self.append(session_id, "message", role=_MESSAGE_ROLES.get(type(message), message.type),
+                           content=message.content, **fields)
+
+    def purge_users(self, user_ids) -> None:
+        """
+        Remove the sessions of the users from the segments and drop their later records. The purge runs in the writer
+        thread after the records queued so far (it is never dropped, this blocks while the queue is full).
+        """
+        if not self.enabled and not os.path.isdir(self.directory):
+            return
+        if self._thread is None:
+            self._start()
+        self._queue.put(_Purge(frozenset(user_ids)))
+
+    def flush(self) -> None:
+        """Wait until all queued records are written."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self) -> None:
+        """Write the queued records and stop the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    # ----------------------------------------------------- writing (the writer thread)
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._thread = threading.Thread(target=self._write_loop, name="transcript-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _segment_path(self) -> str:
+        return os.path.join(self.directory, f"{self._segment_prefix}-{self._segment_number:04d}.jsonl.gz")
+
+    def _write_loop(self) -> None:
+        stopped = False
+        while not stopped:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval_s)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:  # closed
+                stopped = True
+            records = []
+            try:
+                for item in batch:
+                    if isinstance(item, _Purge):
+                        self._write_batch(records)
+                        records = []
+                        self._purge(item.user_ids)
+                    elif item is not None:
+                        records.append(item)
+                self._write_batch(records)
+            except Exception as e:
+                print(e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _is_purged(self, record: dict) -> bool:
+        if record.get("user_id") in self._purged_users:
+            self._purged_sessions.add(record["session_id"])
+        return record["session_id"] in self._purged_sessions
+
+    def _write_batch(self, records: list) -> None:
+        records = [record for record in records if not self._is_purged(record)]
+        if not records:
+            return
+        path = self._segment_path()
+        if os.path.exists(path) and os.path.getsize(path) >= self.segment_max_bytes:
+            self._segment_number += 1
+            path = self._segment_path()
+        data = "".join(json.dumps(record, ensure_ascii=False, default=str) + "\n" for record in records)
+        with open(path, "ab") as f:
+            f.write(gzip.compress(data.encode(), compresslevel=COMPRESS_LEVEL))
+        self.written_records += len(records)
+
+    def _purge(self, user_ids: frozenset) -> None:
+        """Rewrite the segments without the sessions of the users."""
+        self._purged_users |= user_ids
+        paths = sorted(glob.glob(os.path.join(self.directory, "transcript-*.jsonl.gz")))
+        for path in paths:
+            self._purged_sessions.update(record["session_id"] for record in _read_segment(path)
+                                         if record.get("user_id") in user_ids)
+        for path in paths:
+            records = list(_read_segment(path))
+            kept = [record for record in records if record["session_id"] not in self._purged_sessions]
+            if len(kept) == len(records):
+                continue
+            if not kept:
+                os.remove(path)
+                continue
+            data = "".join(json.dumps(record, ensure_ascii=False, default=str) + "\n" for record in kept)
+            with open(path + ".tmp", "wb") as f:
+                f.write(gzip.compress(data.encode(), compresslevel=COMPRESS_LEVEL))
+            os.replace(path + ".tmp", path)
+
+
+transcript_store = TranscriptStore(enabled=os.environ.get("TRANSCRIPTS") == "1")
+
+
+# --------------------------------------------------------- READING
+def _read_segment(path: str):
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+    except (EOFError, gzip.BadGzipFile, zlib.error, json.JSONDecodeError):
+        # the last batch of a segment which is being written (or was cut off)
+        return
+
+
+def read_records(directory: str = TRANSCRIPT_DIR, session_id: str | None = None):
+    """Yield the records of the segments in the directory (of one session if given) in the order they were written."""
+    for path in sorted(glob.glob(os.path.join(directory, "transcript-*.jsonl.gz"))):
+        for record in _read_segment(path):
+            if session_id is None or record["session_id"] == session_id:
+                yield record
+
+
+def read_sessions(directory: str = TRANSCRIPT_DIR) -> dict:
+    """Records of the transcripts grouped by session id."""
+    sessions = defaultdict(list)
+    for record in read_records(directory):
+        sessions[record["session_id"]].append(record)
+    return dict(sessions)
+
+
+def split_turns(records: list) -> tuple:
+    """Split the records of a session into the messages before the first user message and the turns."""
+    preamble, turns = [], []
+    for record in records:
+        if record["type"] == "message" and record["role"] == "human":
+            turns.append({"human": record["content"], "ai": [], "tool_calls": [], "turn": None})
+        elif not turns:
+            preamble.append(record)
+        elif record["type"] == "message" and record["role"] == "ai":
+            turns[-1]["ai"].append(record["content"])
+        elif record["type"] == "tool_call":
+            turns[-1]["tool_calls"].append([record["name"], record["args"]])
+        elif record["type"] == "turn":
+            turns[-1]["turn"] = record
+    return preamble, turns
+
+
+# --------------------------------------------------------- REPLAY
+async def replay_session(runnable, records: list) -> list:
+    """
+    Feed the user messages of the recorded session back through the graph, the conversation is rebuilt the same way
+    as in the app (the user messages and the text of the responses). Returns a result per turn.
+    """
+    preamble, turns = split_turns(records)
+    messages = [SystemMessage(content=r["content"]) if r["role"] == "system" else AIMessage(content=r["content"])
+                for r in preamble if r["type"] == "message" and r["role"] in ("system", "ai")]
+    results = []
+    for number, turn in enumerate(turns):
+        if turn["turn"] is None:  # the turn did not finish
+            break
+        messages.append(HumanMessage(content=turn["human"]))
+        start = time.perf_counter()
+        try:
+            output = await runnable.ainvoke({"messages": messages, "user_id": turn["turn"]["user_id"]})
+            error = None
+        except Exception as e:
+            output, error = {"messages": messages}, repr(e)
+        latency_s = time.perf_counter() - start
+
+        new_messages = output["messages"][len(messages):]
+        text = "".join(m.content for m in new_messages if isinstance(m, AIMessage))
+        tool_calls = [[call["name"], call["args"]] for m in new_messages if isinstance(m, AIMessage)
+                      for call in m.tool_calls]
+        messages.append(AIMessage(content=text))
+        results.append({
+            "session_id": records[0]["session_id"],
+            "turn": number,
+            "recorded_latency_s": turn["turn"]["latency_s"],
+            "latency_s": round(latency_s, 3),
+            "same_tool_calls": tool_calls == turn["tool_calls"],
+            "same_response": text == "".join(turn["ai"]),
+            "saved_prompt_tokens": sum(m.response_metadata.get("tool_selection", {}).get("saved_prompt_tokens", 0)
+                                       for m in new_messages if isinstance(m, AIMessage)),
+            "error": error,
+        })
+    return results
+
+
+async def replay(sessions: dict, db_file: str, concurrency: int = 1) -> list:
+    """Replay the sessions (up to concurrency of them at a time) against a copy of the database."""
+    import graph
+    db_copy = os.path.join(tempfile.mkdtemp(), "replay.sqlite")
+    shutil.copyfile(db_file, db_copy)
+    graph.db = db_copy
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def replay_one(records):
+        async with semaphore:
+            return await replay_session(graph.graph_runnable, records)
+
+    results = await asyncio.gather(*(replay_one(records) for records in sessions.values()))
+    return [result for session_results in results for result in session_results]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("db_file", help="Database the sessions are replayed against (a copy of it)")
+    parser.add_argument("--dir", default=TRANSCRIPT_DIR)
+    parser.add_argument("--session", action="append", help="Session id to replay (all sessions by default)")
+    parser.add_argument("--concurrency", type=int, default=1)
+    args = parser.parse_args()
+
+    transcript_store.enabled = False  # the replayed turns are not recorded again
+    sessions = read_sessions(args.dir)
+    if args.session:
+        sessions = {session_id: sessions[session_id] for session_id in args.session if session_id in sessions}
+    results = asyncio.run(replay(sessions, args.db_file, args.concurrency))
+    for result in results:
+        print(json.dumps(result))
+    if results:
+        latencies = sorted(result["latency_s"] for result in results)
+        print(json.dumps({
+            "sessions": len(sessions),
+            "turns": len(results),
+            "p50_s": round(statistics.median(latencies), 3),
+            "p95_s": round(latencies[int(0.95 * (len(latencies) - 1))], 3),
+            "same_tool_calls": sum(result["same_tool_calls"] for result in results),
+            "same_response": sum(result["same_response"] for result in results),
+            "saved_prompt_tokens": sum(result["saved_prompt_tokens"] for result in results),
+            "errors": sum(result["error"] is not None for result in results),
+        }))
@@ -1,14 +1,24 @@
+import json
+import math
 import re
+import threading
 import uuid
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from enum import Enum
+from enum import Enum, IntEnum
+from functools import lru_cache
+
+from transcript_store import transcript_store
 
 # Model
 MODEL_NAME = "gpt-4o-mini"  # INPUT TOKEN LIMIT: 124k, OUTPUT TOKEN LIMIT: 4096 (or 16,384)
+FALLBACK_MODEL_NAMES = ("gpt-3.5-turbo",)  # tried in order when the primary model fails or times out
 TEMPERATURE = 0.0
 MAX_TOKENS = 4000
 MAX_TOKENS_USER_PROMPT = 100
 MAX_LENGTH_USER_PROMPT = 200
+# tokens kept free for the model's response when checking the projected conversation size
+RESERVED_COMPLETION_TOKENS = 256
 
 
 # Database statuses
@@ -47,6 +57,48 @@ INVALID_APPOINTMENT_TABLE_STATUSES = _INVALID_APPOINTMENT_STATUSES + _INVALID_CA
 POSSIBLE_MISSING_DATA_VALUES = ("", "...", "N/A")
 
 
+# Appointment scheduling rules
+MINIMUM_LEAD_TIME = timedelta(hours=2)
+MAXIMUM_ADVANCE_TIME = timedelta(days=60)
+
+# precompiled validation patterns
+_EMAIL_PATTERN = r"[_a-z0-9-]+(\.[_a-z0-9-]+)*@[a-z0-9-]+(\.[a-z0-9-]+)*(\.[a-z]{2,4})"
+_PHONE_PATTERN = r"(\+\d{1,3}[ .-]?)(\d{3}[ .-]?\d{3}[ .-]?\d{4})"
+_EMAIL_RE = re.compile(_EMAIL_PATTERN)
+_PHONE_RE = re.compile(_PHONE_PATTERN)
+_PHONE_SEPARATORS_RE = re.compile(r"[ .-]")
+# patterns matching whole lines, used for validating many values at once
+_EMAIL_LINE_RE = re.compile(f"^{_EMAIL_PATTERN}$", re.MULTILINE)
+_PHONE_LINE_RE = re.compile(f"^{_PHONE_PATTERN}$", re.MULTILINE)
+
+
+# Validation error codes
+class ValidationCode(IntEnum):
+    VALID = 0
+    INVALID_FORMAT = 1
+    TOO_FAR_IN_ADVANCE = 2
+    IN_THE_PAST = 3
+    TOO_SHORT_NOTICE = 4
+    OUTSIDE_WORKING_HOURS = 5
+    NO_TIME_LEFT = 6
+    WEEKEND = 7
+    INVALID_MINUTES = 8
+    PHONE_TOO_LONG = 9
+    PHONE_NO_COUNTRY_CODE = 10
+    PHONE_TOO_SHORT = 11
+
+
+VALIDATION_MESSAGES = {
+    ValidationCode.TOO_FAR_IN_ADVANCE: "Appointments cannot be scheduled more than 60 days in advance",
+    ValidationCode.IN_THE_PAST: "Provided date and time are in the past",
+    ValidationCode.TOO_SHORT_NOTICE: "Appointments must be scheduled at least 2 hour in advance",
+    ValidationCode.OUTSIDE_WORKING_HOURS: "Time is outside of working hours",
+    ValidationCode.NO_TIME_LEFT: "Time is between 17:30 and 18 oclock. There's no time left for appointment",
+    ValidationCode.WEEKEND: "Provided date is a weekend day",
+    ValidationCode.INVALID_MINUTES: "Appointments can only be scheduled at 00 or 30 minutes past the hour",
+}
+
+
 # Custom exceptions
 class TokenExceededException(Exception):
     pass
@@ -56,79 +108,308 @@ class ValidationException(Exception):
     pass
 
 
+class ConcurrentUpdateException(Exception):
+    pass
+
+
+# Token estimation
+# tiktoken's file reading is replaced while an encoding loads
+_TIKTOKEN_LOAD_LOCK = threading.Lock()
+
+
+class TokenEstimator:
+    """
+    Offline estimate of the prompt tokens of chat messages. The model's tokenizer (tiktoken) is used if it is installed
+    and its encoding is in the local tiktoken cache (e.g. a vendored file in TIKTOKEN_CACHE_DIR), otherwise the tokens
+    are approximated as four characters per token. Token counts of messages are cached, so counting a growing
+    conversation only tokenizes the new messages.
+    """
+    # tokens added by the chat format to every message and to the reply
+    TOKENS_PER_MESSAGE = 3
+    TOKENS_PER_REPLY = 3
+
+    def __init__(self, model_name: str = MODEL_NAME, cache_size: int = 4096) -> None:
+        self.model_name = model_name
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._encode = None
+
+    @staticmethod
+    def _get_cached_encoding(encoding_name: str):
+        """
+        Load the encoding with tiktoken from its local cache only. tiktoken downloads a missing encoding (without a
+        timeout), so its file reading is replaced while the encoding loads and a missing encoding fails instead.
+        """
+        import tiktoken
+        import tiktoken.load
+
+        def read_file_offline(blobpath: str) -> bytes:
+            raise FileNotFoundError(f"{blobpath} is not in the local tiktoken cache.")
+
+        with _TIKTOKEN_LOAD_LOCK:
+            read_file = tiktoken.load.read_file
+            tiktoken.load.read_file = read_file_offline
+            try:
+                return tiktoken.get_encoding(encoding_name)
+            finally:
+                tiktoken.load.read_file = read_file
+
+    def _load_encoding(self):
+        try:
+            import tiktoken
+            try:
+                encoding_name = tiktoken.encoding_name_for_model(self.model_name)
+            except KeyError:
+                encoding_name = "o200k_base"
+            return self._get_cached_encoding(encoding_name).encode_ordinary
+        except Exception:  # not installed or the encoding is not cached
+            return self._approximate
+
+    @staticmethod
+    def _approximate(text: str) -> list:
+        # about four characters per token (English text with the o200k and cl100k encodings)
+        return [None] * math.ceil(len(text) / 4)
+
+    def count_text(self, text: str) -> int:
+        if self._encode is None:
+            self._encode = self._load_encoding()
+        return len(self._encode(text))
+
+    def count_message(self, message) -> int:
+        """Count tokens of a message (content and tool calls) including the chat format overhead."""
+        content = message.content if isinstance(message.content, str) else json.dumps(message.content)
+        tool_calls = getattr(message, "tool_calls", None)
+        key = (message.type, content, json.dumps(tool_calls) if tool_calls else None)
+        if (tokens := self._cache.get(key)) is not None:
+            self._cache.move_to_end(key)
+            return tokens
+
+        tokens = self.TOKENS_PER_MESSAGE + self.count_text(content)
+        if tool_calls:
+            tokens += sum(self.count_text(call["name"]) + self.count_text(json.dumps(call["args"]))
+                          for call in tool_calls)
+        self._cache[key] = tokens
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return tokens
+
+    def count_messages(self, messages: list) -> int:
+        return sum(self.count_message(message) for message in messages) + self.TOKENS_PER_REPLY
+
+
+token_estimator = TokenEstimator()
+
+
+def check_token_budget(messages: list, extra_tokens: int = 0, max_tokens: int = MAX_TOKENS) -> int:
+    """
+    Check the projected size of the next model call (messages, extra tokens such as tool schemas and the tokens reserved
+    for the response) before calling the model. Returns the projected number of tokens.
+    """
+    projected_tokens = token_estimator.count_messages(messages) + extra_tokens + RESERVED_COMPLETION_TOKENS
+    if projected_tokens > max_tokens:
+        raise TokenExceededException("Token limit exceeded. Restart the conversation.", "")
+    return projected_tokens
+
+
 # Validation
 def user_prompt_validation(user_prompt: str) -> None:
     """Validate user input to the model."""
-    if len(user_prompt) > 200:
+    if len(user_prompt) > MAX_LENGTH_USER_PROMPT or token_estimator.count_text(user_prompt) > MAX_TOKENS_USER_PROMPT:
         raise ValidationException("Your prompt too long!")
 
 
 def validate_user_email_address(user_email: str) -> None:
     """Check if the provided email address is valid."""
-    match = re.match('^[_a-z0-9-]+(\.[_a-z0-9-]+)*@[a-z0-9-]+(\.[a-z0-9-]+)*(\.[a-z]{2,4})$', user_email)
-    if match is None:
+    if _EMAIL_RE.fullmatch(user_email) is None:
         raise ValidationException("Invalid email address.")
 
 
 def validate_user_phone_number(user_phone_number: str) -> str:
     """Check if the provided phone number is valid."""
     user_phone_number = user_phone_number.strip()
-    if len(user_phone_number) > 31 or (sum(c.isdigit() for c in user_phone_number) > 15):
+    digits = sum(c.isdigit() for c in user_phone_number)
+    if len(user_phone_number) > 31 or digits > 15:
         raise ValidationException("Phone number is too long.")
     if "+" not in user_phone_number:
         raise ValidationException("Phone number does not have country code.")
-    if sum(c.isdigit() for c in user_phone_number) < 11:
+    if digits < 11:
         raise ValidationException("Phon number is too short.")
 
     # if user_phone_number[2] == user_phone_number[3] == 0:                     ????
     #     raise ValidationException("Invalid phone number.")
-    match = re.match(r'^(\+\d{1,3}[\s.-]?)(\d{3}[\s.-]?\d{3}[\s.-]?\d{4})$', user_phone_number)
-    if match is None:
+    if _PHONE_RE.fullmatch(user_phone_number) is None:
         raise ValidationException("Invalid phone number. Check if the carrier is present and the phone"
                                   "number is separated by space or '.' and '-' characters.")
-    for char in ["-", " ", "."]:
-        if char in user_phone_number:
-            user_phone_number = user_phone_number.replace(char, "")
-    return user_phone_number
+    return _PHONE_SEPARATORS_RE.sub("", user_phone_number)
 
 
 def validate_datetime(date_time: str, datetime_format="%Y-%m-%dT%H:%M") -> None:
     """Validate date and time formats."""
-    readable_datetime_format = make_datetime_format_readable(datetime_format)
     try:
-        datetime.strptime(date_time, datetime_format)
+        datetime_datetime = datetime.strptime(date_time, datetime_format)
     except ValueError:
-        raise ValidationException(f"Invalid datetime format. Must be {readable_datetime_format}.")
-
-    # date_time = f"{date} {time}"
-    # date_time_format = f"{date_format} {time_format}"
-    # if datetime.strptime(date_time, date_time_format) < datetime.now():
-    #     raise ValidationException(f"Date is in the past. Date must be more than {str(datetime.now())}")
+        raise ValidationException(f"Invalid datetime format. Must be {make_datetime_format_readable(datetime_format)}.")
 
-    date, time = date_time.split("T")
+    code = check_appointment_datetime(datetime_datetime, datetime.now())
+    if code == ValidationCode.WEEKEND:
+        raise ValidationException(f"Provided date is a {'Saturday' if datetime_datetime.weekday() == 5 else 'Sunday'}")
+    if code != ValidationCode.VALID:
+        raise ValidationException(VALIDATION_MESSAGES[code])
 
-    date_datetime = datetime.strptime(date, "%Y-%m-%d").date()
-    time_datetime = datetime.strptime(time, "%H:%M").time()
 
-    datetime_datetime = datetime.combine(date_datetime, time_datetime)
-    now = datetime.now()
-    minimum_lead_time = timedelta(hours=2)
-    maximum_advance_time = timedelta(days=60)
+def check_appointment_datetime(datetime_datetime: datetime, now: datetime) -> "ValidationCode":
+    """Check the appointment datetime against the service rules, return the code of the first broken rule."""
+    date_datetime = datetime_datetime.date()
+    time_datetime = datetime_datetime.time()
 
-    if datetime_datetime - now > maximum_advance_time:
-        raise ValidationException("Appointments cannot be scheduled more than 60 days in advance")
+    if datetime_datetime - now > MAXIMUM_ADVANCE_TIME:
+        return ValidationCode.TOO_FAR_IN_ADVANCE
     if date_datetime < now.date() or (date_datetime == now.date() and time_datetime < now.time()):
-        raise ValidationException("Provided date and time are in the past")
-    if datetime_datetime - now < minimum_lead_time:
-        raise ValidationException("Appointments must be scheduled at least 2 hour in advance")
+        return ValidationCode.IN_THE_PAST
+    if datetime_datetime - now < MINIMUM_LEAD_TIME:
+        return ValidationCode.TOO_SHORT_NOTICE
     if not (9 <= time_datetime.hour < 18):
-        raise ValidationException(f"Time is outside of working hours")
+        return ValidationCode.OUTSIDE_WORKING_HOURS
     if (17 < time_datetime.hour <= 18) and (30 < time_datetime.minute):
-        raise ValidationException(f"Time is between 17:30 and 18 oclock. There's no time left for appointment")
+        return ValidationCode.NO_TIME_LEFT
     if date_datetime.weekday() in [5, 6]:
-        raise ValidationException(f"Provided date is a {'Saturday' if date_datetime.weekday() == 5 else 'Sunday'}")
+        return ValidationCode.WEEKEND
     if time_datetime.minute not in [0, 30]:
-        raise ValidationException("Appointments can only be scheduled at 00 or 30 minutes past the hour")
+        return ValidationCode.INVALID_MINUTES
+    return ValidationCode.VALID
+
+
+# Batch validation (NumPy). Every value gets a ValidationCode, the rules are the same as in the validators above.
+def validate_batch(datetimes=None, emails=None, phone_numbers=None, now: datetime | None = None) -> dict:
+    """
+    Validate columns of appointment datetimes (format: YYYY-MM-DDTHH:MM), email addresses and phone numbers in one
+    vectorized pass per column. Returns a dictionary of the given columns' names and arrays of per-row error codes
+    (ValidationCode, 0 means valid).
+    """
+    codes = {}
+    if datetimes is not None:
+        codes["datetimes"] = _validate_datetimes_batch(datetimes, now or datetime.now())
+    if emails is not None:
+        codes["emails"] = _validate_emails_batch(emails)
+    if phone_numbers is not None:
+        codes["phone_numbers"] = _validate_phone_numbers_batch(phone_numbers)
+    return codes
+
+
+def _fullmatch_rows(values: list, line_pattern: re.Pattern):
+    """
+    Fullmatch each of the string values with the pattern in one regex pass over the values joined by new lines.
+    Values containing a new line never match.
+    """
+    import numpy as np
+
+    text = "\n".join(values)
+    has_newline = None
+    if text.count("\n") != max(len(values) - 1, 0):
+        has_newline = np.fromiter(("\n" in value for value in values), dtype=bool, count=len(values))
+        values = ["" if newline else value for value, newline in zip(values, has_newline)]
+        text = "\n".join(values)
+    lengths = np.fromiter(map(len, values), dtype=np.int64, count=len(values))
+    row_starts = np.cumsum(lengths + 1) - (lengths + 1)
+    match_starts = np.fromiter((m.start() for m in line_pattern.finditer(text)), dtype=np.int64)
+
+    matched = np.zeros(len(values), dtype=bool)
+    matched[np.searchsorted(row_starts, match_starts)] = True
+    if has_newline is not None:
+        matched &= ~has_newline
+    return matched
+
+
+def _as_code_points(values):
+    """View an array of strings as a matrix of unicode code points (one row per string, zero padded)."""
+    import numpy as np
+
+    width = max(values.dtype.itemsize // 4, 1)
+    return np.ascontiguousarray(values.astype(f"<U{width}")).view(np.uint32).reshape(len(values), width)
+
+
+def _set_first_codes(codes, checks) -> None:
+    """Set the code of the first failed check (in the given order) for rows which have no code yet."""
+    for code, failed in checks:
+        codes[(codes == ValidationCode.VALID) & failed] = code
+
+
+def _validate_emails_batch(emails):
+    import numpy as np
+
+    emails = [str(email) for email in emails]
+    codes = np.zeros(len(emails), dtype=np.int8)
+    codes[~_fullmatch_rows(emails, _EMAIL_LINE_RE)] = ValidationCode.INVALID_FORMAT
+    return codes
+
+
+def _validate_phone_numbers_batch(phone_numbers):
+    import numpy as np
+
+    phone_numbers = np.char.strip(np.asarray(phone_numbers, dtype=str))
+    code_points = _as_code_points(phone_numbers)
+    digits = ((code_points - ord("0")) <= 9).sum(axis=1)  # padding and other characters wrap around
+    codes = np.zeros(len(phone_numbers), dtype=np.int8)
+    _set_first_codes(codes, [
+        (ValidationCode.PHONE_TOO_LONG, (np.char.str_len(phone_numbers) > 31) | (digits > 15)),
+        (ValidationCode.PHONE_NO_COUNTRY_CODE, ~(code_points == ord("+")).any(axis=1)),
+        (ValidationCode.PHONE_TOO_SHORT, digits < 11),
+        (ValidationCode.INVALID_FORMAT, ~_fullmatch_rows(phone_numbers.tolist(), _PHONE_LINE_RE)),
+    ])
+    return codes
+
+
+# positions of the fields in YYYY-MM-DDTHH:MM
+_DATETIME_LENGTH = 16
+_DATETIME_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15]
+_DATETIME_SEPARATORS = {4: "-", 7: "-", 10: "T", 13: ":"}
+
+
+def _validate_datetimes_batch(datetimes, now: datetime):
+    import numpy as np
+
+    datetimes = np.asarray(datetimes, dtype=str)
+    codes = np.zeros(len(datetimes), dtype=np.int8)
+
+    # fixed-width rows are parsed from the matrix of code points
+    code_points = _as_code_points(datetimes.astype(f"<U{_DATETIME_LENGTH}"))
+    regular = np.char.str_len(datetimes) == _DATETIME_LENGTH
+    regular &= ((code_points[:, _DATETIME_DIGITS] - ord("0")) <= 9).all(axis=1)
+    for position, separator in _DATETIME_SEPARATORS.items():
+        regular &= code_points[:, position] == ord(separator)
+
+    digits = (code_points[:, _DATETIME_DIGITS].astype(np.int64) - ord("0")) * regular[:, None]
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month, day = digits[:, 4] * 10 + digits[:, 5], digits[:, 6] * 10 + digits[:, 7]
+    hour, minute = digits[:, 8] * 10 + digits[:, 9], digits[:, 10] * 10 + digits[:, 11]
+
+    month_start = ((year - 1970) * 12 + np.clip(month, 1, 12) - 1).astype("datetime64[M]")
+    days_in_month = ((month_start + 1).astype("datetime64[D]") - month_start.astype("datetime64[D]")).astype(np.int64)
+    days = month_start.astype("datetime64[D]").astype(np.int64) + day - 1  # days since the unix epoch
+    valid = regular & (year >= 1) & (1 <= month) & (month <= 12) & (1 <= day) & (day <= days_in_month)
+    valid &= (hour <= 23) & (minute <= 59)
+
+    # rows with another layout which strptime accepts (e.g. single digit fields) are checked one by one
+    for i in np.flatnonzero(~regular):
+        try:
+            codes[i] = check_appointment_datetime(datetime.strptime(datetimes[i], "%Y-%m-%dT%H:%M"), now)
+        except ValueError:
+            codes[i] = ValidationCode.INVALID_FORMAT
+
+    now_seconds = (now - _UNIX_EPOCH).total_seconds()
+    seconds = (days * 1440 + hour * 60 + minute) * 60
+    today = now.toordinal() - _UNIX_EPOCH_ORDINAL
+    _set_first_codes(codes, [
+        (ValidationCode.INVALID_FORMAT, regular & ~valid),
+        (ValidationCode.TOO_FAR_IN_ADVANCE, valid & (seconds - now_seconds > MAXIMUM_ADVANCE_TIME.total_seconds())),
+        (ValidationCode.IN_THE_PAST, valid & ((days < today) | ((days == today) & (seconds < now_seconds)))),
+        (ValidationCode.TOO_SHORT_NOTICE, valid & (seconds - now_seconds < MINIMUM_LEAD_TIME.total_seconds())),
+        (ValidationCode.OUTSIDE_WORKING_HOURS, valid & ~((9 <= hour) & (hour < 18))),
+        (ValidationCode.NO_TIME_LEFT, valid & (17 < hour) & (hour <= 18) & (30 < minute)),
+        (ValidationCode.WEEKEND, valid & ((days + 3) % 7 >= 5)),  # the unix epoch was a Thursday
+        (ValidationCode.INVALID_MINUTES, valid & (minute != 0) & (minute != 30)),
+    ])
+    return codes
 
 
 def check_missing_data(*values, possible_missing_values=POSSIBLE_MISSING_DATA_VALUES) -> None:
@@ -139,6 +420,7 @@ def check_missing_data(*values, possible_missing_values=POSSIBLE_MISSING_DATA_VA
         raise ValidationException("Some values are missing.")
 
 
+@lru_cache(maxsize=None)
 def make_datetime_format_readable(datetime_format) -> str:
     """Reformat datetime format into a readable format. Examples: %Y-%m-%dT%H:%M:%S -> YYYY-MM-DDTHH:MM:SS."""
     date_format, time_format = datetime_format.split("T")
@@ -169,8 +451,63 @@ def create_or_ignore_user_id(cursor, phone_number: str) -> str:
     return res[0]
 
 
+def soft_delete_users(cursor, user_ids: list, date_deleted: str) -> int:
+    """
+    Mark the users as deleted in one statement. Their cars and appointments (and the denormalized user_status and
+    car_status columns) are updated by the cascade triggers of the database, their conversations are purged from the
+    transcripts. Returns the number of deleted users.
+    """
+    cursor.execute(f"""
+    UPDATE users SET status = ?, date_deleted = ?, version = version + 1
+    WHERE (id IN (SELECT value FROM json_each(?)) AND {DELETED_STATUS_QUERY_USER_TABLE})
+    """, (ActivityStatus.DELETED.value, date_deleted, json.dumps(list(user_ids))) + INVALID_USER_TABLE_STATUSES)
+    transcript_store.purge_users(user_ids)
+    return cursor.rowcount
+
+
+def fetchone_as_dict(cursor) -> dict | None:
+    """Fetch the next row of the executed query as a dictionary (column name -> value)."""
+    if (row := cursor.fetchone()) is None:
+        return None
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+def get_patch(possible_missing_values=POSSIBLE_MISSING_DATA_VALUES, **values) -> dict:
+    """Get the provided values (column -> new value). Missing values mean the column is left unchanged."""
+    return {column: value for column, value in values.items()
+            if value is not None and value not in possible_missing_values}
+
+
+def patch_row(cursor, table: str, current: dict, patch: dict, date_updated: str) -> bool:
+    """
+    Update only the columns of the row whose values differ from the current ones. The update is guarded by the row's
+    current version (optimistic concurrency), if the row was changed in the meantime ConcurrentUpdateException is
+    raised. Returns whether the row was updated.
+    """
+    changes = {column: value for column, value in patch.items() if str(current[column]) != str(value)}
+    if not changes:
+        return False
+    columns = ", ".join(f'"{column}" = ?' for column in changes)
+    cursor.execute(f"""
+    UPDATE {table} SET {columns}, date_updated = ?, version = version + 1 WHERE id = ? AND version = ?
+    """, (*changes.values(), date_updated, current["id"], current["version"]))
+    if cursor.rowcount == 0:
+        raise ConcurrentUpdateException(f"Row {current['id']} in {table} was changed in the meantime.")
+    return True
+
+
+def to_day_ordinal(date_str: str) -> int:
+    """Convert a date (YYYY-MM-DD) to the number of days since the unix epoch, as stored in the database."""
+    try:
+        return datetime.strptime(date_str.strip(), "%Y-%m-%d").toordinal() - _UNIX_EPOCH_ORDINAL
+    except ValueError:
+        raise ValidationException(f"Invalid date format. Must be {DATE_FORMAT}.")
+
+
 # Datetime formats
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
 TIME_FORMAT = "HH:MM"
 DATE_FORMAT = "YYYY-MM-DD"
 DATETIME_FORMAT_READABLE = make_datetime_format_readable(DATETIME_FORMAT)
+_UNIX_EPOCH = datetime(1970, 1, 1)
+_UNIX_EPOCH_ORDINAL = _UNIX_EPOCH.toordinal()